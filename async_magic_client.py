@@ -0,0 +1,43 @@
+import asyncio
+from async_reliable_UDP import open_connection
+from magic_server import parse_args
+
+# Server details
+SERVER_IP = "127.0.0.1"  # Change to the actual server IP if running remotely
+SERVER_PORT = 12345
+
+
+async def main():
+    loop = asyncio.get_running_loop()
+    args = parse_args("Magic 8-Ball async UDP client")
+    print("Welcome to the Magic 8-Ball! Type your question and press Enter.")
+    print("Type 'exit' to quit.\n")
+
+    # Setup reliable data transfer connection
+    rdtConnect = await open_connection(SERVER_IP, SERVER_PORT, trace=args.trace, link=args.link, window_size=args.window_size, delayed_ack=args.delayed_ack)
+
+    # Loop until exited
+    while True:
+        # Get user input - input() blocks, so it runs off the event loop
+        question = (await loop.run_in_executor(None, input, "Ask the Magic 8-Ball a question: ")).strip()
+
+        # Close connection and quit
+        if question.lower() == "exit":
+            print("Goodbye!")
+            await rdtConnect.close()
+            break
+
+        # Send question to server
+        await rdtConnect.send(question.encode())
+
+        # Receive response - b"" means the server closed the connection
+        response = await rdtConnect.receive()
+        if not response:
+            break
+        print(f"Magic 8-Ball says: {response.decode()}\n")
+    if args.trace is not None:
+        args.trace.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
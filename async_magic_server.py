@@ -0,0 +1,60 @@
+import asyncio
+import random
+import signal
+from async_reliable_UDP import start_server
+from magic_server import HOST, PORT, MAGIC_8_BALL_RESPONSES, parse_args
+from status_server import StatusServer
+
+
+# Serve one client until it disconnects - each client runs as its own task on the event loop
+async def serve_client(rdtConnect):
+    while True:
+        # Receive data from client - a batch client keeps many questions in flight, so we take
+        # every question that is already here, not just the first
+        stream, data = await rdtConnect.receive_message()
+        if not data:
+            # Client closed the connection
+            break
+        answers = []
+        for stream, data in [(stream, data)] + rdtConnect.receive_waiting():
+            question = data.decode().strip()
+
+            # Pick a random Magic 8-Ball response
+            response = random.choice(MAGIC_8_BALL_RESPONSES)
+
+            # Log the interaction
+            print(f"Received question: '{question}' from {rdtConnect.peer}")
+            print(f"Magic 8-Ball response: '{response}'\n")
+
+            # Each answer goes back on the stream its question came in on, which is how the
+            # client matches them up
+            answers.append(rdtConnect.send(response.encode(), stream=stream))
+
+        # Send our responses over our reliable data transfer connection - on different streams they go side by side
+        await asyncio.gather(*answers)
+
+
+async def main():
+    args = parse_args("Magic 8-Ball async UDP server", server=True)
+    server = await start_server(serve_client, HOST, PORT, trace=args.trace, link=args.link, window_size=args.window_size, delayed_ack=args.delayed_ack, streams=True)
+    print(f"Magic 8-Ball async UDP server listening on {HOST}:{PORT}")
+    # The status endpoint has its own thread, so it asks the event loop for the stats
+    loop = asyncio.get_running_loop()
+    status = None
+    if args.status is not None:
+        async def stats():
+            return server.stats()
+        status = StatusServer(args.status, lambda: asyncio.run_coroutine_threadsafe(stats(), loop).result())
+    # Ctrl-C or SIGTERM ends the server
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, server.close)
+    await server.serve_forever()
+    print("Server shutting down...")
+    if status is not None:
+        status.close()
+    if args.trace is not None:
+        args.trace.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
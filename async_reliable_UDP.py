@@ -0,0 +1,676 @@
+import asyncio
+import logging
+import struct
+import time
+
+from more_reliable_UDP import RDTProtocol, ConnectionStats, ResumptionTokens, Session
+from packet_trace import PacketTrace
+
+# Packet types, header layout, states and tuning constants are shared with the blocking version, along with
+# everything in RDTProtocol that does not care how the datagrams are sent
+RDT = RDTProtocol
+
+# Off unless the application configures logging, same as the blocking version
+logger = logging.getLogger(__name__)
+
+
+# Hands every datagram from an asyncio transport to a callback - a single connection on the
+# client side, or the server, which sorts them out by peer address
+class RDTDatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, on_datagram):
+        self.on_datagram = on_datagram
+
+    def datagram_received(self, data, addr):
+        self.on_datagram(data, addr)
+
+    # ICMP errors (nobody listening yet, etc.) are left to the retransmission timers
+    def error_received(self, exc):
+        pass
+
+
+# asyncio version of RDTOverUDP.
+# It speaks the same wire protocol, so async and blocking peers can talk to each other, but nothing
+# here blocks: packets are handled as they arrive from the DatagramProtocol and every retransmission
+# is a timer on the event loop. One thread can drive as many connections as it likes.
+#     connection = await open_connection(host, port)
+#     await connection.send(data)
+#     data = await connection.receive()
+#     await connection.close()
+# Both ends can send at once, and with streams several sends can be running at once on one connection.
+class AsyncRDTConnection(RDTProtocol):
+    # Initialize variables on creation - see RDTProtocol for the options.
+    # transport, peer and server are set when an AsyncRDTServer creates us for one of its clients.
+    def __init__(self, host, port, window_size=1, segment_size=RDT.DEFAULT_SEGMENT_SIZE, transport=None, peer=None, server=None, trace=None, link=None,
+                 delayed_ack=False, tokens=None, session=None, streams=False, wire_version=RDT.WIRE_VERSION):
+        super().__init__(host, port, window_size, segment_size, trace, link, delayed_ack, tokens, session, streams, wire_version)
+        self.transport = transport
+        self.peer = peer # None on the client, whose transport is connected to the server
+        self.server = server
+        # Sending - every DATA packet waiting for an ACK, by sequence number: [packet, resend timer, first send time]
+        # (the send time is dropped once the packet has been resent, per Karn's rule)
+        self.unacked = {}
+        self.send_locks = {} # One send at a time on each stream
+        self.progress = asyncio.Event() # Set whenever ACKs free up the window, or we close
+        self.dup_acks = 0
+        self.fast_resent = set()
+        # Receiving
+        self.segments = asyncio.Queue() # (stream id, segment, final, length) in order for their stream, None once we are closed
+        self.receive_lock = asyncio.Lock() # One reader at a time, so messages do not get mixed up
+        self.mid_message = False # Some of a message has been delivered but not its final segment
+        self.last_data_time = 0.0
+        # Handshake and teardown
+        self.handshake_packet = None # Our last CONNECT, SYNACK or handshake ACK, resent on duplicates
+        self.handshake_timer = None
+        self.handshake_retries = 0
+        self.handshake_sent = None # When handshake_packet first went out - None once it has been resent (Karn's rule)
+        self.established = asyncio.Event()
+        self.disconnected = asyncio.Event()
+        self.torn_down = False
+        self.early_sent = 0 # Client side - bytes of our first message that went in the CONNECT
+
+    ########################
+    ##### Public API #######
+    ########################
+
+    # Client side handshake - CONNECT, SYNACK, ACK - or just CONNECT and SYNACK when the server takes
+    # our session's token. early_data works like it does for RDTOverUDP.rdt_client_connect: with a
+    # session its first segment goes in the CONNECT, and the rest is sent once we are connected.
+    async def connect(self, early_data=None):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: RDTDatagramProtocol(self.datagram_received), remote_addr=(self.host, self.port))
+        options = self.handshake_options(self.max_segment_size)
+        early = b""
+        if self.session is not None:
+            options[RDT.OPTION_TOKEN] = self.session.token
+            if early_data:
+                early = bytes(memoryview(early_data)[:self.session.segment_size])
+                self.early_sent = len(early)
+        payload = RDT.pack_options(options)
+        if early:
+            payload += RDT.EARLY_DATA_SEPARATOR + early
+        self.handshake_packet = self.send_packet(RDT.PACKET_TYPE_CONNECT, payload, final=bool(early) and self.early_sent == len(early_data))
+        self.handshake_sent = time.monotonic()
+        self.set_state(RDT.STATE_SYN_REQUESTED)
+        for attempt in range(RDT.CONNECT_RETRY):
+            try:
+                await asyncio.wait_for(self.established.wait(), self.rtt.rto)
+                break
+            except asyncio.TimeoutError:
+                # Nothing back yet - resend the CONNECT
+                self.rtt.backoff()
+                self.transmit(self.resent(self.handshake_packet))
+                self.handshake_sent = None
+        if self.state != RDT.STATE_ESTABLISHED:
+            self.set_state(RDT.STATE_CLOSED)
+            self.teardown()
+            raise ConnectionError("Failed to connect - connect retry limit reached")
+        # Whatever of the first message did not go in the CONNECT
+        if early_data and self.early_sent < len(early_data):
+            await self.send(memoryview(early_data)[self.early_sent:])
+
+    # Server side - wait until the client that created us finishes the handshake
+    async def accept(self):
+        await self.established.wait()
+        if self.state != RDT.STATE_ESTABLISHED:
+            raise ConnectionError("Failed to connect - handshake did not complete")
+
+    # Reliably send one message, keeping up to window_size segments in flight (fewer if the
+    # congestion window or the peer's receive window say so). Sends on different streams share
+    # the window, and each one only waits for the ACKs of its own segments.
+    async def send(self, payload, stream=0):
+        if stream != 0 and not self.stream_header:
+            raise ValueError("streams were not agreed with the peer")
+        if not 0 <= stream <= RDT.MAX_STREAM:
+            raise ValueError(f"stream ids go from 0 to {RDT.MAX_STREAM}")
+        async with self.send_locks.setdefault(stream, asyncio.Lock()):
+            await self.legacy_cooldown()
+            loop = asyncio.get_running_loop()
+            total = -(-len(payload) // self.segment_size)
+            view = memoryview(payload)
+            sent = []
+            for index in range(total):
+                # Wait for room in the window
+                while self.seq_num + 1 >= self.send_base() + self.send_window():
+                    await self.wait_for_progress()
+                segment = view[index * self.segment_size:(index + 1) * self.segment_size]
+                stream_seq = None
+                if self.stream_header:
+                    stream_seq = (stream, self.stream_seqs.get(stream, 0))
+                    self.stream_seqs[stream] = stream_seq[1] + 1
+                packet = self.send_packet(RDT.PACKET_TYPE_DATA, segment, final=index == total - 1, stream=stream_seq, length=len(payload))
+                timer = loop.call_later(self.rtt.rto, self.retransmit, self.seq_num)
+                self.unacked[self.seq_num] = [packet, timer, time.monotonic()]
+                sent.append(self.seq_num)
+            # Wait for the rest of the ACKs
+            while any(seq in self.unacked for seq in sent):
+                await self.wait_for_progress()
+
+    # Forget a stream both ends are done with - see RDTProtocol.close_stream. Not while a send is still using it.
+    def close_stream(self, stream):
+        lock = self.send_locks.get(stream)
+        if lock is not None and lock.locked():
+            raise ValueError(f"stream {stream} is still sending")
+        super().close_stream(stream)
+        self.send_locks.pop(stream, None)
+
+    # Reliably receive one message - gives b"" once the connection is closed
+    async def receive(self):
+        return (await self.receive_message())[1]
+
+    # Waits for the next message to finish on any stream and gives back (stream, message), or (0, b"")
+    # once the connection is closed. A message never waits for segments of another stream.
+    async def receive_message(self):
+        async with self.receive_lock:
+            while not self.completed:
+                segment = await self.next_segment()
+                if segment is None:
+                    # Closed part way through - the rest of the message is never coming
+                    return 0, b""
+                self.buffer_segment(*segment)
+            return self.completed.popleft()
+
+    # Every message that has already come in whole, as (stream, message), without waiting for more -
+    # a server can answer all of them at once. Nothing, if somebody else is receiving right now.
+    def receive_waiting(self):
+        if self.receive_lock.locked():
+            return []
+        while not self.segments.empty():
+            segment = self.segments.get_nowait()
+            if segment is None:
+                self.segments.put_nowait(None)
+                break
+            self.buffer_segment(*segment)
+        messages = list(self.completed)
+        self.completed.clear()
+        return messages
+
+    # Streaming receive - yields the segments of one message in order as they arrive, so a large
+    # message never has to be held in memory at once. The message is over when the iterator is.
+    # With streams, it is the next message to start arriving - other streams are kept for receive_message.
+    #     async for segment in connection.receive_stream():
+    #         out_file.write(segment)
+    async def receive_stream(self):
+        async with self.receive_lock:
+            if self.completed:
+                yield self.completed.popleft()[1]
+                return
+            target = None
+            while True:
+                segment = await self.next_segment()
+                if segment is None:
+                    return
+                stream, payload, final, length = segment
+                if target is None:
+                    target = stream
+                    # Whatever we already have of its message comes first
+                    buffer = self.stream_buffers.pop(stream, None)
+                    if buffer:
+                        yield buffer.take(partial=True)
+                if stream != target:
+                    self.buffer_segment(stream, payload, final, length)
+                    continue
+                yield payload
+                if final:
+                    return
+
+    # Teardown - DISCONNECT until the peer answers, or we run out of retries
+    async def close(self):
+        if self.state != RDT.STATE_CLOSED:
+            # Don't leave the peer waiting on an ACK we were holding back
+            if self.segments_unacked:
+                self.send_ack()
+            self.set_state(RDT.STATE_CLOSE_WAIT)
+            for attempt in range(RDT.CONNECT_RETRY):
+                self.send_packet(RDT.PACKET_TYPE_DISCONNECT, b"")
+                try:
+                    await asyncio.wait_for(self.disconnected.wait(), self.rtt.rto)
+                    break
+                except asyncio.TimeoutError:
+                    self.rtt.backoff()
+            self.set_state(RDT.STATE_CLOSED)
+        self.teardown()
+
+    ###############################
+    ##### Packet handling #########
+    ###############################
+
+    # Every datagram for this connection comes through here
+    def datagram_received(self, data, address):
+        if not data or self.state == RDT.STATE_CLOSED:
+            return
+        self.counters.packets_received += 1
+        self.counters.bytes_received += len(data)
+        # Too short or corrupted - as good as lost
+        header = self.codec.parse(data)
+        if header is None:
+            logger.debug("Dropped corrupt packet")
+            self.counters.corrupt_received += 1
+            return
+        packet_type, seq_num, ack_num, final, resent, rwnd, stream, length, payload = header
+        if packet_type == RDT.PACKET_TYPE_RESET:
+            self.counters.resets_received += 1
+        # Keep track of how much room the peer says it has left
+        if rwnd is not None:
+            self.rwnd = rwnd
+        logger.debug("Received packet type %d with sequence %d, ack %d, final %d, %d byte payload",
+                     packet_type, seq_num, ack_num, final, len(payload))
+        if self.trace is not None:
+            self.trace.record(PacketTrace.RECEIVED, packet_type, seq_num, ack_num, final, resent, rwnd, len(payload), self.peer_port())
+
+        if packet_type == RDT.PACKET_TYPE_CONNECT:
+            if self.state == RDT.STATE_LISTEN:
+                self.ack_num = seq_num + 1
+                # Agree on a segment size and receive window with the client
+                options, early_data = RDT.split_connect(payload)
+                options = RDT.parse_options(options)
+                try:
+                    self.negotiate(options)
+                except ValueError as error:
+                    # Garbage options are a bad packet - give up on this peer, which also drops us from the server
+                    logger.warning("Bad CONNECT from %s: %s", self.peer, error)
+                    self.fail_handshake()
+                    return
+                synack_options = self.handshake_options(self.segment_size)
+                # Clients that understand options get a token to come back with next time
+                if not self.legacy_peer:
+                    synack_options[RDT.OPTION_TOKEN] = self.tokens.issue(self.peer[0])
+                # A client presenting a good token is ESTABLISHED as soon as we answer, and any
+                # early data it sent along is ours - our SYNACK acknowledges it
+                if self.tokens.check(options.get(RDT.OPTION_TOKEN, ""), self.peer[0]):
+                    synack_options[RDT.OPTION_RESUMED] = 1
+                    if early_data is not None:
+                        self.ack_num += 1
+                    self.handshake_packet = self.send_packet(RDT.PACKET_TYPE_SYNACK, RDT.pack_options(synack_options))
+                    self.set_state(RDT.STATE_ESTABLISHED)
+                    self.established.set()
+                    # Early data is the first segment of stream 0
+                    if early_data is not None:
+                        self.deliver_segment(self.segments, bytes(early_data), final, (0, 0) if self.stream_header else None)
+                # Otherwise any early data is dropped - the client sends it again once we are connected
+                else:
+                    self.handshake_packet = self.send_packet(RDT.PACKET_TYPE_SYNACK, RDT.pack_options(synack_options))
+                    self.handshake_sent = time.monotonic()
+                    self.set_state(RDT.STATE_SYNACK_SENT)
+                    self.handshake_timer = asyncio.get_running_loop().call_later(self.rtt.rto, self.handshake_timeout)
+            elif self.handshake_packet is not None:
+                # The client missed our SYNACK
+                self.transmit(self.resent(self.handshake_packet))
+                self.handshake_sent = None
+        elif packet_type == RDT.PACKET_TYPE_SYNACK:
+            options = RDT.parse_options(payload)
+            resumed = RDT.OPTION_RESUMED in options
+            # A resumed SYNACK also acknowledges our early data
+            if self.state == RDT.STATE_SYN_REQUESTED and ack_num == self.seq_num + 1 + (resumed and self.early_sent > 0):
+                # Handshake complete, move on!
+                self.ack_num = seq_num + 1
+                self.handshake_rtt(resent)
+                try:
+                    self.negotiate(options)
+                except ValueError as error:
+                    # A server sending garbage options is not one we can talk to
+                    logger.warning("Bad SYNACK: %s", error)
+                    self.fail_handshake()
+                    return
+                if RDT.OPTION_TOKEN in options:
+                    self.session = Session(options[RDT.OPTION_TOKEN], self.segment_size)
+                # The server took our token, so it is already ESTABLISHED and needs no ACK
+                if resumed:
+                    self.seq_num += self.early_sent > 0
+                    self.handshake_packet = None
+                    if self.early_sent and self.stream_header:
+                        self.stream_seqs[0] = 1
+                else:
+                    self.handshake_packet = self.send_packet(RDT.PACKET_TYPE_ACK, b"")
+                    self.early_sent = 0
+                self.set_state(RDT.STATE_ESTABLISHED)
+                self.established.set()
+            elif self.state == RDT.STATE_ESTABLISHED and self.handshake_packet is not None:
+                # The server missed our handshake ACK
+                self.transmit(self.resent(self.handshake_packet))
+        # A resumed server already answering our early data - we missed its SYNACK, which it sends
+        # again when our CONNECT repeats, and the DATA comes round again after that
+        elif self.state == RDT.STATE_SYN_REQUESTED:
+            pass
+        elif self.state == RDT.STATE_SYNACK_SENT:
+            if packet_type == RDT.PACKET_TYPE_ACK and ack_num == self.seq_num + 1:
+                self.ack_num = seq_num + 1
+                self.handshake_rtt(resent)
+                self.handshake_done()
+            # DATA that acknowledges our SYNACK means the handshake ACK was lost on the way
+            elif packet_type == RDT.PACKET_TYPE_DATA and ack_num == self.seq_num + 1:
+                self.ack_num += 1
+                self.handshake_done()
+                self.handle_data(seq_num, final, stream, length, payload)
+        elif packet_type == RDT.PACKET_TYPE_ACK:
+            self.handle_ack(seq_num, ack_num, payload)
+        elif packet_type == RDT.PACKET_TYPE_DATA:
+            # DATA also acknowledges everything of ours before its ack_num, like TCP
+            self.handle_ack(seq_num, ack_num, b"", from_data=True, resent=resent)
+            self.handle_data(seq_num, final, stream, length, payload)
+        elif packet_type == RDT.PACKET_TYPE_DISCONNECT:
+            # The peer has all of our data before its ack_num
+            self.handle_ack(seq_num, ack_num, b"", from_data=True, resent=resent)
+            self.send_packet(RDT.PACKET_TYPE_DISCONNECT_ACK, b"")
+            self.set_state(RDT.STATE_CLOSED)
+            self.teardown()
+        elif packet_type == RDT.PACKET_TYPE_DISCONNECT_ACK:
+            self.disconnected.set()
+        # The peer has thrown the connection away - a send waiting on it fails, like the blocking version's
+        elif packet_type == RDT.PACKET_TYPE_RESET and self.state == RDT.STATE_ESTABLISHED and self.unacked:
+            logger.warning("Connection reset by peer - giving up on the send")
+            self.set_state(RDT.STATE_CLOSED)
+            self.teardown()
+
+    # Server side - the client is ESTABLISHED
+    def handshake_done(self):
+        self.handshake_timer.cancel()
+        self.set_state(RDT.STATE_ESTABLISHED)
+        self.established.set()
+
+    # Server side - our SYNACK went unanswered
+    def handshake_timeout(self):
+        if self.state != RDT.STATE_SYNACK_SENT:
+            return
+        self.handshake_retries += 1
+        if self.handshake_retries == RDT.CONNECT_RETRY:
+            logger.warning("Failed to connect - connect retry limit reached")
+            self.set_state(RDT.STATE_CLOSED)
+            self.teardown()
+            return
+        self.rtt.backoff()
+        self.transmit(self.resent(self.handshake_packet))
+        self.handshake_sent = None
+        self.handshake_timer = asyncio.get_running_loop().call_later(self.rtt.rto, self.handshake_timeout)
+
+    # The peer answered our CONNECT or SYNACK - that is the first RTT sample, so the connection does not
+    # start out on the initial timeout. Not if either end had to resend its part (Karn's rule).
+    def handshake_rtt(self, resent):
+        if self.handshake_sent is not None and not resent:
+            self.sample_rtt(self.handshake_sent)
+        self.handshake_sent = None
+
+    # The peer's handshake made no sense - RESET it and close, which wakes up connect or accept
+    def fail_handshake(self):
+        self.send_packet(RDT.PACKET_TYPE_RESET, b"")
+        self.set_state(RDT.STATE_CLOSED)
+        self.teardown()
+
+    # ack_num acknowledges everything before it, an ACK payload lists segments held past a gap
+    def handle_ack(self, seq_num, ack_num, payload, from_data=False, resent=False):
+        if not self.unacked:
+            return
+        base = self.send_base()
+        newly_acked = [seq for seq in self.unacked if seq < ack_num]
+        newly_acked += [seq for seq in self.codec.parse_sack(payload) if seq in self.unacked and seq >= ack_num]
+        if newly_acked:
+            # Legacy receivers spend a sequence number on every ACK, so their next DATA follows it
+            if self.legacy_peer and not from_data:
+                self.ack_num = seq_num + 1
+            # Time the round trip off the newest packet this covers, if it was only sent once.
+            # DATA goes out whenever the peer's application gets round to it, so only real ACKs are timed -
+            # unless the peer delays its ACKs, when its DATA never goes out later than the ACK would have.
+            # Not if it is resent DATA, though: then it went out a whole timeout later (Karn's rule).
+            sent = None if from_data and (resent or not self.peer_delays_acks) else self.unacked[max(newly_acked)][2]
+            if sent is not None:
+                self.sample_rtt(sent)
+            else:
+                self.rtt.restore()
+            self.congestion.on_ack(len(newly_acked))
+            for seq in newly_acked:
+                self.unacked.pop(seq)[1].cancel()
+                self.fast_resent.discard(seq)
+            self.progress.set()
+        if from_data:
+            return
+        if self.unacked and self.send_base() == base:
+            # The oldest packet is still missing while ACKs keep arriving - it was probably lost
+            self.dup_acks += 1
+            self.counters.dup_acks += 1
+            if self.dup_acks >= RDT.DUP_ACK_THRESHOLD and base not in self.fast_resent:
+                logger.debug("Fast retransmit of sequence %d", base)
+                self.fast_resent.add(base)
+                self.congestion.on_loss()
+                self.retransmit(base, backoff=False)
+        else:
+            self.dup_acks = 0
+
+    # Put DATA in order and hand the segments to receive() - with streams, each stream in its own order
+    def handle_data(self, seq_num, final, stream, length, payload):
+        self.last_data_time = time.monotonic()
+        # Gaps, gap fills and repeats are acknowledged straight away, so the peer hears about
+        # them quickly - the same goes for every segment without delayed ACKs
+        ack_now = self.accept_data(self.segments, seq_num, final, stream, length, payload) or not self.delayed_ack or self.legacy_peer
+        # Acknowledge every few segments (every segment if our window would stall the sender otherwise),
+        # or hold the ACK back in case our own DATA can carry it - always at the end of a message
+        if ack_now or (self.mid_message and self.segments_unacked >= min(RDT.DELAYED_ACK_SEGMENTS, self.window_size)):
+            self.send_ack()
+        elif self.ack_timer is None:
+            self.ack_timer = asyncio.get_running_loop().call_later(RDT.DELAYED_ACK_TIMEOUT, self.send_ack)
+
+    # Cumulative ACK plus the segments we hold past a gap. ACKs do not consume a sequence number.
+    def send_ack(self):
+        self.ack_sent()
+        seq_num = min(self.unacked) - 1 if self.unacked else self.seq_num
+        self.send_packet(RDT.PACKET_TYPE_ACK, self.codec.pack_sack(self.out_of_order), final=not self.mid_message, seq_num=seq_num)
+
+    # Resend timer for one DATA packet ran out (or fast retransmit)
+    def retransmit(self, seq, backoff=True):
+        entry = self.unacked.get(seq)
+        if entry is None or self.state == RDT.STATE_CLOSED:
+            return
+        # Back off once per loss event - when the oldest packet times out
+        if backoff and seq == self.send_base():
+            self.rtt.backoff()
+            self.congestion.on_timeout()
+        entry[0] = self.resent(entry[0])
+        entry[1].cancel()
+        entry[1] = asyncio.get_running_loop().call_later(self.rtt.rto, self.retransmit, seq)
+        entry[2] = None
+        self.transmit(entry[0])
+
+    ###########################
+    ##### Helpers #############
+    ###########################
+
+    # Build and send a packet - new packets take the next sequence number, ACKs pass theirs in.
+    # DATA carries stream, its (stream id, number in stream), once we have agreed to streams, and the
+    # length of its whole message.
+    def send_packet(self, packet_type, payload, final=False, seq_num=None, stream=None, length=0):
+        # Only take the sequence number once the packet is built - if it cannot be, nothing is skipped
+        new = seq_num is None
+        if new:
+            seq_num = self.seq_num + 1
+        packet = self.codec.pack(packet_type, seq_num, self.ack_num, RDT.ENABLE_FLAG if final else RDT.DISABLE_FLAG,
+                                 RDT.DISABLE_FLAG, self.receive_window(), payload, stream, length)
+        if new:
+            self.seq_num = seq_num
+        logger.debug("Sending packet type %d with sequence %d, ack %d, final %d, %d byte payload",
+                     packet_type, seq_num, self.ack_num, final, len(payload))
+        # DATA carries our ACK number, so any ACK we were holding back rides along with it
+        if packet_type == RDT.PACKET_TYPE_DATA:
+            self.ack_sent()
+            self.counters.data_bytes_sent += len(payload)
+        self.transmit(packet)
+        return packet
+
+    # Turn a packet's resent flag on (and bring its receive window up to date) - gives back the marked
+    # packet, a copy the first time (see HeaderCodec.mark_resent)
+    def resent(self, packet):
+        self.counters.retransmits += 1
+        return self.codec.mark_resent(packet, self.receive_window())
+
+    # Hand a packet to the transport through our link layer, which may drop or delay it
+    def transmit(self, packet):
+        if self.transport is None or self.transport.is_closing():
+            return
+        self.counters.packets_sent += 1
+        self.counters.bytes_sent += len(packet)
+        if packet[0] == RDT.PACKET_TYPE_RESET:
+            self.counters.resets_sent += 1
+        sent = self.link.send(self.transport.sendto, packet, self.peer)
+        if not sent:
+            logger.debug("(Dropped send)")
+        if self.trace is not None:
+            self.trace_packet(PacketTrace.SENT if sent else PacketTrace.DROPPED, packet)
+
+    # Next (stream id, segment, final, length), or None once the connection is closed.
+    # The None is put back so every later reader sees the close too.
+    async def next_segment(self):
+        segment = await self.segments.get()
+        if segment is None:
+            self.segments.put_nowait(None)
+        return segment
+
+    # Oldest sequence number still waiting for an ACK
+    def send_base(self):
+        return min(self.unacked) if self.unacked else self.seq_num + 1
+
+    async def wait_for_progress(self):
+        self.progress.clear()
+        await self.progress.wait()
+        if self.state == RDT.STATE_CLOSED and self.unacked:
+            raise ConnectionError("Connection closed while sending")
+
+    # A legacy peer cannot cope with our DATA before it has its final ACK, so give it the
+    # same quiet period the blocking version waits out after a final segment
+    async def legacy_cooldown(self):
+        if self.legacy_peer:
+            while True:
+                wait = self.last_data_time + RDT.TIMEOUT * RDT.COOLDOWN_MULTIPLIER - time.monotonic()
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+    # Segments for receive() go on our queue - ready is always self.segments
+    def hand_over(self, ready, stream, payload, final, length):
+        self.mid_message = not final
+        ready.put_nowait((stream, payload, final, length))
+
+    # Everything received but not looked at yet is on the queue
+    def queued(self):
+        return len(self.unacked), self.segments.qsize()
+
+    # Port of the other end - a client's transport is connected to the server's port
+    def peer_port(self):
+        return self.port if self.peer is None else self.peer[1]
+
+    # Stop every timer and wake anybody waiting on us - safe to call more than once
+    def teardown(self):
+        if self.torn_down:
+            return
+        self.torn_down = True
+        for packet, timer, sent in self.unacked.values():
+            timer.cancel()
+        if self.handshake_timer is not None:
+            self.handshake_timer.cancel()
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+        self.segments.put_nowait(None)
+        self.progress.set()
+        self.established.set()
+        if self.server is not None:
+            self.server.remove(self)
+        elif self.transport is not None:
+            self.transport.close()
+
+
+# asyncio server - one DatagramProtocol on one socket, sorting datagrams out by peer address.
+# Each client gets its own AsyncRDTConnection, and handler(connection) runs as its own task
+# once the handshake is complete.
+class AsyncRDTServer:
+    # Any extra keyword options (window_size, segment_size...) are passed on to every connection.
+    # Every connection shares our ResumptionTokens, so a token from one is good for the next.
+    def __init__(self, handler, host, port, **options):
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.options = options
+        self.options.setdefault("tokens", ResumptionTokens())
+        self.transport = None
+        self.connections = {} # Peer address -> AsyncRDTConnection
+        self.accepted = 0 # Connections started so far
+        self.finished = None # Merged stats() of every connection that has closed
+        self.tasks = set()
+        self.closed = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.closed = loop.create_future()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: RDTDatagramProtocol(self.datagram_received), local_addr=(self.host, self.port))
+
+    def datagram_received(self, data, address):
+        if not data:
+            return
+        connection = self.connections.get(address)
+        if connection is None:
+            # Only a CONNECT starts a new connection
+            if data[0] == RDT.PACKET_TYPE_CONNECT:
+                connection = AsyncRDTConnection(self.host, self.port, transport=self.transport, peer=address, server=self, **self.options)
+                connection.set_state(RDT.STATE_LISTEN)
+                self.connections[address] = connection
+                self.accepted += 1
+                task = asyncio.get_running_loop().create_task(self.serve(connection))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            # The peer of a connection we already closed missed our DISCONNECT_ACK - send it another
+            elif data[0] == RDT.PACKET_TYPE_DISCONNECT:
+                self.transport.sendto(struct.pack(RDT.HEADER_FORMAT, RDT.PACKET_TYPE_DISCONNECT_ACK, 0, 0, 0, 0), address)
+                return
+            # Anything else is left over from an old connection
+            else:
+                return
+        connection.datagram_received(data, address)
+
+    # Run the handler for one client, and make sure the connection is closed afterwards
+    async def serve(self, connection):
+        try:
+            await connection.accept()
+            await self.handler(connection)
+        except ConnectionError as error:
+            logger.warning("Connection from %s failed: %s", connection.peer, error)
+        finally:
+            await connection.close()
+
+    # Forget a connection once it is closed - its stats go into our running total
+    def remove(self, connection):
+        if self.connections.get(connection.peer) is connection:
+            del self.connections[connection.peer]
+            self.finished = ConnectionStats.merge([self.finished, connection.stats()])
+
+    # Stats of every connection we have had, added up - see RDTListener.stats. Call it on the event loop.
+    def stats(self):
+        snapshot = ConnectionStats.merge([self.finished] + [connection.stats() for connection in self.connections.values()])
+        snapshot.update(accepted=self.accepted, open=len(self.connections), draining=False)
+        return snapshot
+
+    # Run until close() is called
+    async def serve_forever(self):
+        await self.closed
+
+    # Stop listening - this drops every connection still open
+    def close(self):
+        for connection in list(self.connections.values()):
+            connection.set_state(RDT.STATE_CLOSED)
+            connection.teardown()
+        for task in self.tasks:
+            task.cancel()
+        self.transport.close()
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+
+# Connect to an RDT server and hand back the ESTABLISHED connection, sending early_data as its
+# first message (see AsyncRDTConnection.connect)
+async def open_connection(host, port, early_data=None, **options):
+    connection = AsyncRDTConnection(host, port, **options)
+    await connection.connect(early_data)
+    return connection
+
+
+# Start an RDT server calling handler(connection) for every client
+async def start_server(handler, host, port, **options):
+    server = AsyncRDTServer(handler, host, port, **options)
+    await server.start()
+    return server
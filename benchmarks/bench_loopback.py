@@ -0,0 +1,168 @@
+import argparse
+import os
+import statistics
+import threading
+import time
+
+from common import percentile, write_results
+from more_reliable_UDP import RDTOverUDP, RDTListener
+from network_emulator import NetworkEmulator
+
+# End-to-end benchmarks over loopback: rdt_client_connect against rdt_server_wait_connect
+# (through an RDTListener in a background thread), measuring
+#   handshake latency
+#   short lived connections - connect, one request/response, close - with a full handshake and resumed
+#   request/response latency percentiles for small messages
+#   bulk goodput across payload sizes and loss rates
+# Both directions go through a seeded NetworkEmulator, so runs with the same --seed see the same losses.
+# Run from the repo root:
+#     python3 benchmarks/bench_loopback.py [--output loopback.json] [--quick]
+
+HOST = "127.0.0.1"
+
+
+# Loopback server - answers every message with its length, so bulk transfers are not echoed back
+class BenchServer:
+    def __init__(self, port, **options):
+        self.listener = RDTListener(HOST, port, **options)
+        self.thread = threading.Thread(target=self.accept_loop, daemon=True)
+        self.thread.start()
+
+    def accept_loop(self):
+        while self.listener.running:
+            connection = self.listener.accept(timeout=0.5)
+            if connection is not None:
+                threading.Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+    def serve(self, connection):
+        connection.rdt_server_wait_connect()
+        while connection.state != RDTOverUDP.STATE_CLOSED:
+            data = connection.rdt_receive()
+            if connection.state == RDTOverUDP.STATE_CLOSED:
+                break
+            connection.rdt_send(str(len(data)).encode())
+
+    def close(self):
+        self.listener.close()
+
+
+def connect(port, early_data=None, **options):
+    connection = RDTOverUDP(HOST, port, **options)
+    connection.rdt_client_connect(early_data)
+    return connection
+
+
+def summarize(samples):
+    return {
+        "count": len(samples),
+        "mean_ms": statistics.mean(samples) * 1e3,
+        "p50_ms": percentile(samples, 50) * 1e3,
+        "p90_ms": percentile(samples, 90) * 1e3,
+        "p99_ms": percentile(samples, 99) * 1e3,
+        "max_ms": max(samples) * 1e3,
+    }
+
+
+def bench_handshake(results, port, link, count, delayed_ack=False):
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        connection = connect(port, link=link, delayed_ack=delayed_ack)
+        samples.append(time.perf_counter() - start)
+        connection.close()
+    results.append({"name": "handshake", **summarize(samples)})
+
+
+def bench_request_response(results, port, link, count, size=32, delayed_ack=False):
+    connection = connect(port, link=link, delayed_ack=delayed_ack)
+    message = os.urandom(size)
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        connection.rdt_send(message)
+        connection.rdt_receive()
+        samples.append(time.perf_counter() - start)
+    connection.close()
+    results.append({"name": "request_response", "payload_bytes": size, **summarize(samples)})
+
+
+# One request per connection - without a session every connection does the full handshake, with
+# one the request goes in the CONNECT
+def bench_reconnect(results, port, link, count, size=32, delayed_ack=False):
+    message = os.urandom(size)
+    session = connect(port, link=link, delayed_ack=delayed_ack)
+    session.close()
+    for resumed in (False, True):
+        samples = []
+        for _ in range(count):
+            start = time.perf_counter()
+            connection = connect(port, early_data=message, link=link, delayed_ack=delayed_ack,
+                                 session=session.session if resumed else None)
+            connection.rdt_receive()
+            connection.close()
+            samples.append(time.perf_counter() - start)
+        results.append({"name": "reconnect.resumed" if resumed else "reconnect.full", "payload_bytes": size, **summarize(samples)})
+
+
+def bench_goodput(results, port, links, seed, sizes, loss_rates, window_size, rounds, delayed_ack=False):
+    for loss in loss_rates:
+        # Same loss both ways, with the RNGs started over so every loss rate gets a reproducible run
+        for index, link in enumerate(links):
+            link.loss = loss
+            link.random.seed(seed + index)
+        connection = connect(port, window_size=window_size, link=links[0], delayed_ack=delayed_ack)
+        for size in sizes:
+            payload = os.urandom(size)
+            samples = []
+            for _ in range(rounds):
+                start = time.perf_counter()
+                connection.rdt_send(payload)
+                reply = connection.rdt_receive()
+                samples.append(time.perf_counter() - start)
+                assert int(reply) == size, reply
+            elapsed = statistics.median(samples)
+            results.append({"name": "goodput", "payload_bytes": size, "loss_rate": loss, "window_size": window_size,
+                            "rounds": rounds, "median_s": elapsed, "mb_per_s": size / elapsed / 1e6})
+        for link in links:
+            link.loss = 0
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RDT end-to-end loopback benchmarks")
+    parser.add_argument("--output", metavar="FILE", help="write JSON results here instead of stdout")
+    parser.add_argument("--port", type=int, default=24000)
+    parser.add_argument("--window-size", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.0, help="one way delay added by the emulator, in seconds")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the emulator's loss decisions")
+    parser.add_argument("--delayed-ack", action="store_true", help="run both ends with delayed ACKs")
+    parser.add_argument("--quick", action="store_true", help="fewer rounds and smaller payloads")
+    args = parser.parse_args()
+
+    if args.quick:
+        count, rounds, sizes, loss_rates = 20, 1, [16 * 1024, 128 * 1024], [0, 0.1]
+    else:
+        count, rounds, sizes, loss_rates = 200, 3, [16 * 1024, 256 * 1024, 1024 * 1024], [0, 0.1, 0.2]
+
+    # Client to server and server to client links. Latency numbers are taken without loss -
+    # a single drop costs a whole retransmission timeout.
+    links = [NetworkEmulator(latency=args.latency, seed=args.seed), NetworkEmulator(latency=args.latency, seed=args.seed + 1)]
+    server = BenchServer(args.port, window_size=args.window_size, link=links[1], delayed_ack=args.delayed_ack)
+    results = []
+    try:
+        bench_handshake(results, args.port, links[0], count, args.delayed_ack)
+        bench_request_response(results, args.port, links[0], count, delayed_ack=args.delayed_ack)
+        bench_reconnect(results, args.port, links[0], count, delayed_ack=args.delayed_ack)
+        bench_goodput(results, args.port, links, args.seed, sizes, loss_rates, args.window_size, rounds, args.delayed_ack)
+    finally:
+        server.close()
+        for link in links:
+            link.close()
+    for result in results:
+        result["latency_s"] = args.latency
+        result["delayed_ack"] = args.delayed_ack
+    write_results("loopback", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
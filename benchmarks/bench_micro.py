@@ -0,0 +1,121 @@
+import argparse
+import os
+import socket
+import time
+import timeit
+
+from common import write_results
+from more_reliable_UDP import HeaderCodec, RDTOverUDP
+
+# Microbenchmarks for the per-packet hot spots of the blocking transport:
+#   header pack/parse as used by rdt_send_packet and rdt_wait_for_packet, whole packet pack, and marking a packet
+#   resent, in each format
+#   split_payload
+#   receive side reassembly in rdt_receive, in order and with every other pair swapped
+# Run from the repo root:
+#     python3 benchmarks/bench_micro.py [--output micro.json]
+
+SEGMENT_SIZE = RDTOverUDP.DEFAULT_SEGMENT_SIZE
+REPEAT = 5
+
+
+# Best time per call of fn over a few repeats, letting timeit pick the loop count
+def time_per_call(fn):
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=REPEAT, number=number)) / number
+
+
+# A connection that looks ESTABLISHED and sends its ACKs into a local sink socket, so rdt_receive
+# can be fed from stashed_packets without a peer
+def established_connection(sink, window_size):
+    connection = RDTOverUDP("127.0.0.1", sink.getsockname()[1], window_size=window_size)
+    connection.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    connection.client_address = sink.getsockname()
+    connection.state = RDTOverUDP.STATE_ESTABLISHED
+    return connection
+
+
+# header.pack is the header on its own, as it always was, and packet.pack a whole DATA packet with a full
+# segment as rdt_send_packet builds it. A packet is copied the first time it is resent (resent_first) and
+# patched in place after that (resent).
+def bench_headers(results):
+    segment = bytes(SEGMENT_SIZE)
+    codecs = {"original": HeaderCodec(), "rwnd": HeaderCodec(1, extended=True), "v2": HeaderCodec(2, extended=True)}
+    for name, codec in codecs.items():
+        packet = codec.pack(RDTOverUDP.PACKET_TYPE_DATA, 1000, 2000, 0, 0, 16, segment, length=SEGMENT_SIZE)
+        resent_packet = codec.mark_resent(packet, 16)
+        header = time_per_call(lambda: codec.pack(RDTOverUDP.PACKET_TYPE_DATA, 1000, 2000, 0, 0, 16, length=SEGMENT_SIZE))
+        pack = time_per_call(lambda: codec.pack(RDTOverUDP.PACKET_TYPE_DATA, 1000, 2000, 0, 0, 16, segment, length=SEGMENT_SIZE))
+        parse = time_per_call(lambda: codec.parse(packet))
+        resent_first = time_per_call(lambda: codec.mark_resent(packet, 16))
+        resent = time_per_call(lambda: codec.mark_resent(resent_packet, 16))
+        results.append({"name": f"header.pack.{name}", "ns_per_op": header * 1e9})
+        results.append({"name": f"header.parse.{name}", "ns_per_op": parse * 1e9})
+        results.append({"name": f"packet.pack.{name}", "ns_per_op": pack * 1e9})
+        results.append({"name": f"header.resent_first.{name}", "ns_per_op": resent_first * 1e9})
+        results.append({"name": f"header.resent.{name}", "ns_per_op": resent * 1e9})
+
+
+def bench_split_payload(results):
+    connection = RDTOverUDP("127.0.0.1", 0)
+    for size in (64 * 1024, 1024 * 1024):
+        payload = os.urandom(size)
+        per_call = time_per_call(lambda: sum(1 for _ in connection.split_payload(payload)))
+        results.append({"name": "split_payload", "payload_bytes": size, "segment_size": SEGMENT_SIZE,
+                        "us_per_payload": per_call * 1e6, "mb_per_s": size / per_call / 1e6})
+
+
+def bench_reassembly(results, message_size=64 * 1024, window_size=16, messages=50):
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    sink.setblocking(False)
+    payload = os.urandom(message_size)
+    # length is the message length a v2 header carries - the receiver only uses it to check the reassembled
+    # size (see ReassemblyBuffer), so the length runs measure what that check costs on top of the join
+    for reordered, length in ((False, None), (True, None), (False, message_size), (True, message_size)):
+        connection = established_connection(sink, window_size)
+        segments = [bytes(segment) for segment in connection.split_payload(payload)]
+        best = None
+        for _ in range(messages):
+            # Number this message from where the connection expects it, then hand it to rdt_receive
+            packets = []
+            for index, segment in enumerate(segments):
+                final = RDTOverUDP.ENABLE_FLAG if index == len(segments) - 1 else RDTOverUDP.DISABLE_FLAG
+                packets.append((RDTOverUDP.PACKET_TYPE_DATA, connection.ack_num + index, 0, final, 0, None, length, segment))
+            if reordered:
+                for index in range(0, len(packets) - 2, 2):
+                    packets[index], packets[index + 1] = packets[index + 1], packets[index]
+            connection.stashed_packets.extend(packets)
+            start = time.perf_counter()
+            data = connection.rdt_receive()
+            elapsed = time.perf_counter() - start
+            assert data == payload
+            best = elapsed if best is None else min(best, elapsed)
+            # Keep the sink from filling up with our ACKs
+            try:
+                while True:
+                    sink.recv(RDTOverUDP.UDP_BUFFER)
+            except BlockingIOError:
+                pass
+        connection.udp_socket.close()
+        name = "reassembly.reordered" if reordered else "reassembly.in_order"
+        results.append({"name": name + (".length" if length else ""),
+                        "payload_bytes": message_size, "segments": len(segments), "window_size": window_size,
+                        "us_per_message": best * 1e6, "mb_per_s": message_size / best / 1e6})
+    sink.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RDT microbenchmarks")
+    parser.add_argument("--output", metavar="FILE", help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+    results = []
+    bench_headers(results)
+    bench_split_payload(results)
+    bench_reassembly(results)
+    write_results("micro", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+
+# Shared bits for the benchmark scripts - results are written as JSON so runs from
+# different commits can be compared by a script instead of by eye
+
+# The transport modules live in the repo root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+
+# Commit the benchmark ran against, or None outside a git checkout
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Nearest-rank percentile of a list of numbers
+def percentile(values, p):
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+# Write one benchmark run as JSON, to a file or stdout
+def write_results(suite, results, output=None):
+    report = {
+        "suite": suite,
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+            output_file.write("\n")
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
@@ -1,34 +1,100 @@
+import sys
+import time
+from collections import defaultdict, deque
 from more_reliable_UDP import RDTOverUDP
+from magic_server import parse_args
 
 # Server details
 SERVER_IP = "127.0.0.1"  # Change to the actual server IP if running remotely
 SERVER_PORT = 12345
 
-print("Welcome to the Magic 8-Ball! Type your question and press Enter.")
-print("Type 'exit' to quit.\n")
 
-# Setup reliable data transfer connection
-rdtConnect = RDTOverUDP(SERVER_IP, SERVER_PORT)
-rdtConnect.rdt_client_connect()
+# Interactive mode - one question at a time, typed in
+def ask_interactively(rdtConnect):
+    print("Welcome to the Magic 8-Ball! Type your question and press Enter.")
+    print("Type 'exit' to quit.\n")
+
+    # Loop until exited
+    while True:
+        # Get user input
+        question = input("Ask the Magic 8-Ball a question: ").strip()
+
+        # Close connection and quit
+        if question.lower() == "exit":
+            print("Goodbye!")
+            rdtConnect.close()
+            break
+
+        # Send question to server
+        rdtConnect.rdt_send(question.encode())
+
+        # Receive response
+        response = rdtConnect.rdt_receive()
+        # Detect remote close
+        if rdtConnect.state == rdtConnect.STATE_CLOSED:
+            break
+        print(f"Magic 8-Ball says: {response.decode()}\n")
 
-# Loop until exited
-while True:
-    # Get user input
-    question = input("Ask the Magic 8-Ball a question: ").strip()
 
-    # Close connection and quit
-    if question.lower() == "exit":
-        print("Goodbye!")
-        rdtConnect.close()
-        break
+# Batch mode - every non-blank line is a question, and its line number is its request ID.
+# Up to in_flight questions are waiting for answers at once, each on a stream of its own, and an
+# answer is matched to its question by the stream it comes back on - the server answers in
+# whatever order the questions finish arriving. A server without streams answers everything on
+# stream 0 in the order it was asked, which matches up the same way.
+def ask_batch(rdtConnect, lines, in_flight):
+    questions = ((request_id, line.strip()) for request_id, line in enumerate(lines, 1) if line.strip())
+    # Streams with no question waiting on them, and the (request ID, question) waiting on each stream
+    free_streams = deque(rdtConnect.open_stream() for _ in range(in_flight)) if rdtConnect.stream_header else None
+    waiting = defaultdict(deque)
+    outstanding = 0
+    answered = 0
+    start = time.monotonic()
+    while True:
+        # Top up to in_flight questions, all sent in one window
+        batch = []
+        while outstanding + len(batch) < in_flight:
+            item = next(questions, None)
+            if item is None:
+                break
+            stream = free_streams.popleft() if free_streams is not None else 0
+            waiting[stream].append(item)
+            batch.append((stream, item[1].encode()))
+        if batch:
+            rdtConnect.rdt_send_many(batch)
+            outstanding += len(batch)
+        if not outstanding:
+            break
 
-    # Send question to server
-    rdtConnect.rdt_send(question.encode())
+        # Take every answer that is already here
+        responses = [rdtConnect.rdt_receive_message()] + rdtConnect.rdt_receive_waiting()
+        # Detect remote close
+        if rdtConnect.state == rdtConnect.STATE_CLOSED:
+            print(f"Server closed the connection with {outstanding} questions unanswered")
+            break
+        for stream, response in responses:
+            request_id, question = waiting[stream].popleft()
+            if free_streams is not None:
+                free_streams.append(stream)
+            outstanding -= 1
+            answered += 1
+            print(f"[{request_id}] {question} -> {response.decode()}")
+    print(f"{answered} questions answered in {time.monotonic() - start:.2f}s")
+    rdtConnect.close()
+
+
+args = parse_args("Magic 8-Ball UDP client", client=True)
+
+# Setup reliable data transfer connection - a batch keeps its questions apart with streams
+rdtConnect = RDTOverUDP(SERVER_IP, SERVER_PORT, trace=args.trace, link=args.link, window_size=args.window_size, delayed_ack=args.delayed_ack, streams=True)
+rdtConnect.rdt_client_connect()
 
-    # Receive response
-    response = rdtConnect.rdt_receive()
-    # Detect remote close
-    if rdtConnect.state == rdtConnect.STATE_CLOSED:
-        break
-    print(f"Magic 8-Ball says: {response.decode()}\n")
+if args.batch is None:
+    ask_interactively(rdtConnect)
+elif args.batch == "-":
+    ask_batch(rdtConnect, sys.stdin, args.in_flight)
+else:
+    with open(args.batch) as batch_file:
+        ask_batch(rdtConnect, batch_file, args.in_flight)
 
+if args.trace is not None:
+    args.trace.close()
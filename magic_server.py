@@ -1,5 +1,15 @@
+import argparse
+import logging
+import os
 import random
-from more_reliable_UDP import RDTOverUDP
+import signal
+import socket
+import threading
+from more_reliable_UDP import RDTListener
+from network_emulator import NetworkEmulator
+from packet_trace import PacketTrace
+from status_server import StatusServer
+from worker_pool import WorkerPool
 
 # Define server address and port
 HOST = "0.0.0.0"  # Listen on all available network interfaces
@@ -29,34 +39,109 @@ MAGIC_8_BALL_RESPONSES = [
     "Maybe, maybe not."
 ]
 
-# Setup reliable data transfer connection
-rdtConnect = RDTOverUDP(HOST, PORT)
-rdtConnect.rdt_server_wait_connect()
-print(f"Magic 8-Ball UDP server listening on {HOST}:{PORT}")
-
-#Listen until exited
-while True:
-    # I designed this so that if the client exits cleanly, the server will
-    # detect and reinitialize for another connection
-    if rdtConnect.state == rdtConnect.STATE_CLOSED:
-        rdtConnect.rdt_server_wait_connect()
-    # Receive data from client (buffer size = 1024 bytes)
-    data = rdtConnect.rdt_receive()
-    if data:
-        question = data.decode().strip()
-        # The client can also request to kill the server
-        # which ends it for both of them.
-        if question.lower() == "kill":
-            print("Server shutting down...")
-            rdtConnect.close()
-            break
-
-        # Pick a random Magic 8-Ball response
-        response = random.choice(MAGIC_8_BALL_RESPONSES)
-
-        # Log the interaction
-        print(f"Received question: '{question}' from {rdtConnect.client_address}")
-        print(f"Magic 8-Ball response: '{response}'\n")
-
-        # Send our response over our reliable data transfer object
-        packet = rdtConnect.rdt_send(response.encode())
\ No newline at end of file
+# Serve one client until it disconnects - each client gets its own thread and connection state
+def serve_client(rdtConnect):
+    rdtConnect.rdt_server_wait_connect()
+    while rdtConnect.state != rdtConnect.STATE_CLOSED:
+        # Receive data from client - a batch client keeps many questions in flight, so we take
+        # every question that is already here, not just the first
+        questions = [rdtConnect.rdt_receive_message()] + rdtConnect.rdt_receive_waiting()
+        answers = []
+        for stream, data in questions:
+            if not data:
+                continue
+            question = data.decode().strip()
+
+            # Pick a random Magic 8-Ball response
+            response = random.choice(MAGIC_8_BALL_RESPONSES)
+
+            # Log the interaction
+            print(f"Received question: '{question}' from {rdtConnect.client_address}")
+            print(f"Magic 8-Ball response: '{response}'\n")
+
+            # Each answer goes back on the stream its question came in on, which is how the
+            # client matches them up
+            answers.append((stream, response.encode()))
+
+        # Send our responses over our reliable data transfer object, all in one window
+        if answers:
+            rdtConnect.rdt_send_many(answers)
+
+
+# Take clients until the listener stops - each new client is handled on its own thread, so clients
+# that exit cleanly just end their own thread and any number can be connected at once
+def accept_clients(listener):
+    while listener.running:
+        rdtConnect = listener.accept(timeout=1.0)
+        if rdtConnect is not None:
+            threading.Thread(target=serve_client, args=(rdtConnect,), daemon=True).start()
+
+
+# Command line options shared by the servers and clients
+# --verbose logs every packet and state change, --trace writes a binary packet trace (see packet_trace.py)
+# --loss/--latency/--jitter/--seed send our packets through a NetworkEmulator to try out a bad network
+# --window-size has to be at least --in-flight on both ends for a batch to really keep that many questions in flight
+# --batch/--in-flight are for magic_client.py, which passes client=True
+# --status is for the servers, which pass server=True - GET http://127.0.0.1:PORT/ for the server's stats as JSON
+# --workers is for magic_server.py, which passes workers=True - every worker then writes its own --trace file
+def parse_args(description, client=False, server=False, workers=False):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--verbose", action="store_true", help="log every packet and state change")
+    parser.add_argument("--trace", metavar="FILE", help="record every packet to a binary trace file")
+    parser.add_argument("--loss", type=float, default=0.0, help="chance of dropping each packet we send")
+    parser.add_argument("--latency", type=float, default=0.0, help="delay added to each packet we send, in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random +/- variation on the delay, in seconds")
+    parser.add_argument("--seed", type=int, help="seed for the emulated network, for repeatable runs")
+    parser.add_argument("--delayed-ack", action="store_true", help="hold back ACKs so replies can carry them")
+    parser.add_argument("--window-size", type=int, default=32, help="segments we keep in flight, and can take out of order")
+    if client:
+        parser.add_argument("--batch", metavar="FILE", help="ask every line of FILE (- for stdin) instead of prompting")
+        parser.add_argument("--in-flight", type=int, default=32, help="questions a batch keeps waiting for answers at once")
+    if server:
+        parser.add_argument("--status", type=int, metavar="PORT", help="serve connection stats as JSON on localhost:PORT")
+    if workers:
+        parser.add_argument("--workers", type=int, default=1, help="worker processes sharing the port (SIGHUP restarts them)")
+    args = parser.parse_args()
+    # Every question in flight has a stream of its own, and stream ids are 16 bits
+    if client and not 1 <= args.in_flight <= 0xFFFF:
+        parser.error("--in-flight must be between 1 and 65535")
+    if workers and args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if workers and args.workers > 1 and not (hasattr(socket, "SO_REUSEPORT") and hasattr(os, "fork")):
+        parser.error("--workers needs SO_REUSEPORT and fork, which this platform does not have")
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG, format="%(asctime)s %(name)s %(message)s")
+    args.trace_path = args.trace
+    args.trace = PacketTrace(args.trace) if args.trace and not (workers and args.workers > 1) else None
+    args.link = None
+    if args.loss or args.latency or args.jitter:
+        args.link = NetworkEmulator(loss=args.loss, latency=args.latency, jitter=args.jitter, seed=args.seed)
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args("Magic 8-Ball UDP server", server=True, workers=True)
+    options = dict(link=args.link, window_size=args.window_size, delayed_ack=args.delayed_ack, streams=True)
+
+    # Several worker processes on the same port, each with its own clients - the launcher
+    # stops them all on Ctrl-C or SIGTERM, and restarts them on SIGHUP
+    if args.workers > 1:
+        WorkerPool(HOST, PORT, args.workers, accept_clients, trace_path=args.trace_path, status_port=args.status, **options).run()
+    else:
+        # Setup the listener that sorts incoming packets out by client
+        listener = RDTListener(HOST, PORT, trace=args.trace, **options)
+        print(f"Magic 8-Ball UDP server listening on {HOST}:{PORT}")
+        status = StatusServer(args.status, listener.stats) if args.status is not None else None
+        # SIGTERM lets the clients we have finish first, Ctrl-C drops them
+        signal.signal(signal.SIGTERM, lambda signum, frame: listener.drain(timeout=WorkerPool.DRAIN_TIMEOUT))
+
+        # Listen until exited
+        try:
+            accept_clients(listener)
+        except KeyboardInterrupt:
+            listener.close()
+        print("Server shutting down...")
+        if status is not None:
+            status.close()
+        if args.trace is not None:
+            args.trace.close()
@@ -1,14 +1,431 @@
+import hashlib
+import hmac
+import logging
+import os
+import queue
+import select
 import struct
 import socket
-from random import random
+import threading
+import time
+import zlib
+from collections import deque, namedtuple
 
-from math import floor
+from packet_trace import PacketTrace
 
+# Per-packet and state logging is at DEBUG level and goes nowhere unless the application
+# configures logging, e.g. logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
 
-# Class for managing reliable data transfer over UDP
-# This is a basic form of reliability for a class homework assignment
-# and not intended to be thorough! Do not use in production environment!
-class RDTOverUDP:
+# Round trip time estimator driving the retransmission timer.
+# Keeps a smoothed RTT and its variance (the usual TCP recipe from RFC 6298), and doubles
+# the timeout on every loss so we back off instead of hammering a path that is dropping.
+class RTTEstimator:
+    # Gains for the smoothed RTT and the RTT variance
+    ALPHA = 0.125
+    BETA = 0.25
+    # Bounds on the retransmission timeout, in seconds
+    MIN_RTO = 0.02
+    MAX_RTO = 60.0
+
+    def __init__(self, initial_rto):
+        self.srtt = None
+        self.rttvar = None
+        self.base_rto = initial_rto # Timeout before any backoff
+        self.rto = initial_rto
+        self.timeouts = 0 # Times we have backed off, for ConnectionStats
+
+    # Feed in a measured round trip (never from a retransmitted packet - Karn's rule)
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.base_rto = min(max(self.srtt + 4 * self.rttvar, self.MIN_RTO), self.MAX_RTO)
+        self.rto = self.base_rto
+
+    # A retransmission timer ran out
+    def backoff(self):
+        self.rto = min(self.rto * 2, self.MAX_RTO)
+        self.timeouts += 1
+
+    # New data got through, so the path is working again - drop the backoff even without a sample
+    def restore(self):
+        self.rto = self.base_rto
+
+
+# Congestion window for the sender: slow start, then additive increase / multiplicative decrease.
+# The window is counted in segments and never grows past the window_size the connection was made with.
+class CongestionControl:
+    # Segments we are allowed in flight on a fresh connection
+    INITIAL_WINDOW = 4
+    # Never drop the slow start threshold below this many segments
+    MIN_SSTHRESH = 2
+
+    def __init__(self, max_window):
+        self.max_window = max_window
+        self.cwnd = min(self.INITIAL_WINDOW, max_window)
+        self.ssthresh = max_window
+
+    # Segments newly acknowledged - grow by one per segment in slow start, by one per window after that
+    def on_ack(self, count=1):
+        for _ in range(count):
+            if self.cwnd < self.ssthresh:
+                self.cwnd += 1
+            else:
+                self.cwnd += 1 / self.cwnd
+        self.cwnd = min(self.cwnd, self.max_window)
+
+    # Duplicate ACKs told us a segment was lost, but later ones are still getting through - halve the window
+    def on_loss(self):
+        self.ssthresh = max(self.cwnd / 2, self.MIN_SSTHRESH)
+        self.cwnd = min(self.ssthresh, self.max_window)
+
+    # A retransmission timer ran out, so nothing is getting through - start over from one segment
+    def on_timeout(self):
+        self.ssthresh = max(self.cwnd / 2, self.MIN_SSTHRESH)
+        self.cwnd = 1
+
+    # Whole segments the sender may have in flight right now
+    def window(self):
+        return max(1, int(self.cwnd))
+
+
+# Counts of values that fell into each of a fixed set of buckets, like a Prometheus histogram -
+# adding a value is a short scan, and histograms from different connections (or processes) add up
+class Histogram:
+    # Upper bounds of the buckets, in seconds - anything bigger goes in the last, "+Inf" one
+    BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        index = 0
+        while index < len(self.BOUNDS) and value > self.BOUNDS[index]:
+            index += 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    # Plain dicts and numbers, ready for json.dumps
+    def snapshot(self):
+        labels = [str(bound) for bound in self.BOUNDS] + ["+Inf"]
+        return {"count": self.count, "sum": self.sum, "max": self.max, "buckets": dict(zip(labels, self.buckets))}
+
+    # Add up histogram snapshots
+    @staticmethod
+    def merge(snapshots):
+        merged = {"count": 0, "sum": 0.0, "max": 0.0, "buckets": {}}
+        for snapshot in snapshots:
+            merged["count"] += snapshot["count"]
+            merged["sum"] += snapshot["sum"]
+            merged["max"] = max(merged["max"], snapshot["max"])
+            for label, count in snapshot["buckets"].items():
+                merged["buckets"][label] = merged["buckets"].get(label, 0) + count
+        return merged
+
+
+# Counters for one connection - packets and bytes each way, retransmissions, duplicate ACKs, RESETs,
+# round trips, how long the handshake took and how long we spent in each state. They are bumped from
+# whichever thread sends or receives without a lock, so a count can very rarely come up one short.
+# Timeouts, the smoothed RTT and the windows are read straight off the connection - see RDTOverUDP.stats.
+class ConnectionStats:
+    # Our own counters, and everything that just adds up when snapshots are merged
+    COUNTERS = ("packets_sent", "bytes_sent", "packets_received", "bytes_received", "corrupt_received",
+                "data_bytes_sent", "data_bytes_received", "retransmits", "dup_acks", "resets_sent", "resets_received")
+    TOTALS = COUNTERS + ("timeouts", "connections")
+
+    def __init__(self, state):
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.packets_received = 0
+        self.bytes_received = 0
+        self.corrupt_received = 0 # Too short or failed the checksum
+        self.data_bytes_sent = 0 # DATA payload, not counting resends
+        self.data_bytes_received = 0 # DATA payload handed over in order
+        self.retransmits = 0
+        self.dup_acks = 0
+        self.resets_sent = 0
+        self.resets_received = 0
+        self.rtt = Histogram()
+        self.handshake = Histogram()
+        self.handshake_start = None
+        self.state = state
+        self.state_since = time.monotonic()
+        self.state_times = {} # Seconds spent in every state we have left
+        self.lock = threading.Lock() # Only for the state times, which the status endpoint reads from another thread
+
+    # The connection moved to another state - the handshake runs from leaving INIT or LISTEN to ESTABLISHED
+    def set_state(self, state):
+        now = time.monotonic()
+        with self.lock:
+            self.state_times[self.state] = self.state_times.get(self.state, 0.0) + now - self.state_since
+            idle = (RDTOverUDP.STATE_INIT, RDTOverUDP.STATE_LISTEN, RDTOverUDP.STATE_CLOSED)
+            if self.state in idle and state not in idle:
+                self.handshake_start = now
+            if state == RDTOverUDP.STATE_ESTABLISHED and self.handshake_start is not None:
+                self.handshake.add(now - self.handshake_start)
+                self.handshake_start = None
+            self.state = state
+            self.state_since = now
+
+    # Everything counted so far as plain dicts and numbers - the time in our current state counts up to now
+    def snapshot(self):
+        with self.lock:
+            state_times = dict(self.state_times)
+            state_times[self.state] = state_times.get(self.state, 0.0) + time.monotonic() - self.state_since
+        snapshot = {name: getattr(self, name) for name in self.COUNTERS}
+        snapshot.update(connections=1, rtt=self.rtt.snapshot(), handshake=self.handshake.snapshot(), state_times=state_times)
+        return self.add_goodput(snapshot)
+
+    # Add up snapshots from any number of connections (or merged snapshots) into one of the same shape.
+    # Counters, state times and queue depths add up, and histograms merge - anything else belongs to
+    # one connection and is left out.
+    @classmethod
+    def merge(cls, snapshots):
+        snapshots = [snapshot for snapshot in snapshots if snapshot is not None]
+        merged = {name: sum(snapshot.get(name, 0) for snapshot in snapshots) for name in cls.TOTALS}
+        for name in ("rtt", "handshake"):
+            merged[name] = Histogram.merge(snapshot[name] for snapshot in snapshots)
+        for name in ("state_times", "queues"):
+            merged[name] = {}
+            for snapshot in snapshots:
+                for key, value in snapshot.get(name, {}).items():
+                    merged[name][key] = merged[name].get(key, 0) + value
+        return cls.add_goodput(merged)
+
+    # Payload bytes per second each way, over the time spent ESTABLISHED (per connection, when merged)
+    @staticmethod
+    def add_goodput(snapshot):
+        established = snapshot["state_times"].get(RDTOverUDP.STATE_ESTABLISHED, 0.0)
+        snapshot["goodput_sent"] = snapshot["data_bytes_sent"] / established if established else 0.0
+        snapshot["goodput_received"] = snapshot["data_bytes_received"] / established if established else 0.0
+        return snapshot
+
+
+# Collects the in-order segments of one message and joins them once at the end,
+# instead of building a new bytes object for every segment that arrives.
+# join already works out the size and copies everything once, which beats filling in a preallocated
+# bytearray, so a message length from the header (v2 headers have one) is only used to check the result.
+class ReassemblyBuffer:
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+        self.length = None # What the sender said the whole message comes to, if it said
+
+    def append(self, segment, length=None):
+        if not self.chunks:
+            self.length = length
+        self.chunks.append(segment)
+        self.size += len(segment)
+
+    def __len__(self):
+        return self.size
+
+    # The whole message (or, with partial, whatever we have of it so far) - the buffer is empty again afterwards
+    def take(self, partial=False):
+        if not partial and self.length is not None and self.length != self.size:
+            logger.warning("Reassembled %d bytes of a %d byte message", self.size, self.length)
+        message = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        self.length = None
+        return message
+
+
+# Default link layer - datagrams go straight to the socket.
+# Swap in a network_emulator.NetworkEmulator to test against loss, delay and reordering.
+class DirectLink:
+    # Gives False if the link dropped the packet, which a direct link never does
+    def send(self, sendto, packet, address):
+        sendto(packet, address)
+        return True
+
+
+# Resumption tokens - a server hands one out in every SYNACK, and a client that comes back with it
+# can skip the handshake ACK and put its first DATA segment in the CONNECT (0-RTT).
+# Tokens are stateless: an expiry time plus an HMAC over it and the client's IP address, keyed with a
+# secret that lives as long as the server does. One token works for any number of reconnects from the
+# same host until it expires, and the server does not have to remember anything about its clients.
+class ResumptionTokens:
+    LIFETIME = 600 # Seconds a token stays good for
+    MAC_SIZE = 16
+
+    def __init__(self, secret=None, lifetime=LIFETIME):
+        self.secret = secret if secret is not None else os.urandom(32)
+        self.lifetime = lifetime
+
+    # A fresh token for a client at this IP address, as hex so it fits in the handshake options
+    def issue(self, host):
+        expiry = struct.pack("!I", int(time.time() + self.lifetime))
+        return (expiry + self.mac(expiry, host)).hex()
+
+    # Whether a token presented by a client at this IP address is ours and still good
+    def check(self, token, host):
+        try:
+            token = bytes.fromhex(token)
+        except ValueError:
+            return False
+        if len(token) != 4 + self.MAC_SIZE or struct.unpack("!I", token[:4])[0] < time.time():
+            return False
+        return hmac.compare_digest(token[4:], self.mac(token[:4], host))
+
+    def mac(self, expiry, host):
+        return hmac.new(self.secret, expiry + host.encode(), hashlib.sha256).digest()[:self.MAC_SIZE]
+
+
+# What a client keeps from one connection to resume the next - the server's token and the segment
+# size we settled on, which is as much early data as fits in the CONNECT
+Session = namedtuple("Session", "token segment_size")
+
+
+# Builds and reads packet headers for one connection, in whatever format its handshake settled on.
+# Every layout is a precompiled struct.Struct. A packet that has to go again has its resent flag
+# (and receive window) patched in place instead of being parsed and rebuilt.
+#   v1 - the original header, which every packet of the handshake uses whatever the version. Once both
+#        ends have offered a receive window, DATA and ACK carry one, and with streams DATA carries its stream.
+#   v2 - DATA and ACK carry type, a flags byte, receive window, 64 bit sequence and ACK numbers (they never
+#        wrap), stream id and number in stream, the length of the whole message the segment belongs to
+#        (so the receiver knows what it is waiting for) and a CRC32 over the rest of the packet, so a corrupted
+#        datagram is thrown away before it gets anywhere near the FSM. RESET and the DISCONNECTs use the same
+#        layout, so a corrupted type byte cannot turn a packet into one of them and tear the connection down.
+class HeaderCodec:
+    V1 = struct.Struct("!BIIBB")
+    V1_RWND = struct.Struct("!BIIBBH")
+    V1_STREAM = struct.Struct("!BIIBBHHI")
+    V1_RESENT_OFFSET = 10
+    V1_RWND_OFFSET = 11
+    V1_SEQ_MASK = 0xFFFFFFFF
+    V2 = struct.Struct("!BBHQQHIII")
+    V2_FIELDS = struct.Struct("!BBHQQHII") # Everything before the CRC, which comes last
+    V2_FLAGS_OFFSET = 1
+    V2_RWND_OFFSET = 2
+    V2_CRC_OFFSET = V2.size - 4
+    # v2 flags
+    FLAG_FINAL = 0x01
+    FLAG_RESENT = 0x02
+    RWND = struct.Struct("!H")
+    CRC = struct.Struct("!I")
+    # ACK payloads list the sequence numbers a windowed receiver is holding out of order, as wide as the header's
+    SACK_V1 = struct.Struct("!I")
+    SACK_V2 = struct.Struct("!Q")
+    # Longest header any packet can have, for sizing receive buffers
+    MAX_HEADER_SIZE = max(V1_STREAM.size, V2.size)
+
+    # extended - both ends offered a receive window, streams - both ends agreed to streams
+    def __init__(self, version=1, extended=False, streams=False):
+        self.version = version if extended else 1
+        self.streams = streams
+        # Packets that close the connection - checksummed like DATA and ACK under v2
+        self.control_types = (RDTOverUDP.PACKET_TYPE_DISCONNECT, RDTOverUDP.PACKET_TYPE_DISCONNECT_ACK,
+                              RDTOverUDP.PACKET_TYPE_RESET) if self.version == 2 else ()
+        # Packet types that carry more than the original header
+        self.extended_types = (RDTOverUDP.PACKET_TYPE_DATA, RDTOverUDP.PACKET_TYPE_ACK) + self.control_types if extended else ()
+        self.sack = self.SACK_V2 if self.version == 2 else self.SACK_V1
+
+    # Build a whole packet. final and resent are ENABLE_FLAG or DISABLE_FLAG, stream is (stream id, number in
+    # stream) for DATA once we have agreed to streams, and length is the length of the message DATA is part of.
+    # Plain Struct.pack plus concatenation is the fastest way to build one in CPython - packing into a
+    # preallocated bytearray measured 2-4x slower - so packets come out as bytes, and mark_resent copies
+    # the few that get resent.
+    def pack(self, packet_type, seq_num, ack_num, final, resent, rwnd, payload=b"", stream=None, length=0):
+        if packet_type not in self.extended_types:
+            # Only the low 32 bits of v2 numbers fit - nobody checks these past the handshake anyway
+            return self.V1.pack(packet_type, seq_num & self.V1_SEQ_MASK, ack_num & self.V1_SEQ_MASK, final, resent) + payload
+        if self.version == 2:
+            flags = (self.FLAG_FINAL if final else 0) | (self.FLAG_RESENT if resent else 0)
+            stream_id, stream_seq = stream if stream is not None else (0, 0)
+            header = self.V2_FIELDS.pack(packet_type, flags, rwnd, seq_num, ack_num, stream_id, stream_seq, length)
+            # The CRC covers everything but itself - the header before it and the payload after it
+            return b"".join((header, self.CRC.pack(zlib.crc32(payload, zlib.crc32(header))), payload))
+        if self.streams and packet_type == RDTOverUDP.PACKET_TYPE_DATA:
+            return self.V1_STREAM.pack(packet_type, seq_num, ack_num, final, resent, rwnd, *stream) + payload
+        return self.V1_RWND.pack(packet_type, seq_num, ack_num, final, resent, rwnd) + payload
+
+    # Split a packet into (packet_type, seq_num, ack_num, final, resent, rwnd, stream, length, payload), or
+    # None if it is too short or fails its checksum. rwnd is None for packets with the original header,
+    # stream is None without streams and length is None for anything but v2 DATA. The payload is a view of the packet.
+    def parse(self, data):
+        data = memoryview(data)
+        if len(data) < self.V1.size:
+            return None
+        packet_type = data[0]
+        if packet_type not in self.extended_types:
+            return self.V1.unpack_from(data) + (None, None, None, data[self.V1.size:])
+        if self.version == 2:
+            if len(data) < self.V2.size:
+                # Somebody who never settled on v2 with us can still close us down with the original header - a
+                # listener answering for a connection it already dropped, or a peer whose handshake went wrong.
+                # Every v2 packet is longer than this, so it cannot be a corrupted one of ours.
+                if packet_type in self.control_types:
+                    return self.V1.unpack_from(data) + (None, None, None, data[self.V1.size:])
+                return None
+            if self.CRC.unpack_from(data, self.V2_CRC_OFFSET)[0] != self.checksum(data):
+                return None
+            packet_type, flags, rwnd, seq_num, ack_num, stream_id, stream_seq, length, crc = self.V2.unpack_from(data)
+            final = RDTOverUDP.ENABLE_FLAG if flags & self.FLAG_FINAL else RDTOverUDP.DISABLE_FLAG
+            resent = RDTOverUDP.ENABLE_FLAG if flags & self.FLAG_RESENT else RDTOverUDP.DISABLE_FLAG
+            stream = (stream_id, stream_seq) if self.streams else None
+            return packet_type, seq_num, ack_num, final, resent, rwnd, stream, length if packet_type == RDTOverUDP.PACKET_TYPE_DATA else None, data[self.V2.size:]
+        if self.streams and packet_type == RDTOverUDP.PACKET_TYPE_DATA:
+            if len(data) < self.V1_STREAM.size:
+                return None
+            packet_type, seq_num, ack_num, final, resent, rwnd, stream_id, stream_seq = self.V1_STREAM.unpack_from(data)
+            return packet_type, seq_num, ack_num, final, resent, rwnd, (stream_id, stream_seq), None, data[self.V1_STREAM.size:]
+        if len(data) < self.V1_RWND.size:
+            return None
+        return self.V1_RWND.unpack_from(data) + (None, None, data[self.V1_RWND.size:])
+
+    # Mark a packet we built as resent, with our receive window as it is now. Gives back the marked packet -
+    # the first time that is a bytearray copy, which later resends patch in place, so keep what we return.
+    def mark_resent(self, packet, rwnd):
+        if not isinstance(packet, bytearray):
+            packet = bytearray(packet)
+        if packet[0] not in self.extended_types:
+            packet[self.V1_RESENT_OFFSET] = RDTOverUDP.ENABLE_FLAG
+        elif self.version == 2:
+            packet[self.V2_FLAGS_OFFSET] |= self.FLAG_RESENT
+            self.RWND.pack_into(packet, self.V2_RWND_OFFSET, rwnd)
+            self.seal(packet)
+        else:
+            packet[self.V1_RESENT_OFFSET] = RDTOverUDP.ENABLE_FLAG
+            self.RWND.pack_into(packet, self.V1_RWND_OFFSET, rwnd)
+        return packet
+
+    # CRC32 of a v2 packet - everything but the checksum field itself
+    def checksum(self, packet):
+        packet = memoryview(packet)
+        return zlib.crc32(packet[self.V2_CRC_OFFSET + self.CRC.size:], zlib.crc32(packet[:self.V2_CRC_OFFSET]))
+
+    # Fill in the checksum of a v2 packet
+    def seal(self, packet):
+        self.CRC.pack_into(packet, self.V2_CRC_OFFSET, self.checksum(packet))
+
+    # An ACK payload listing the sequence numbers we hold out of order
+    def pack_sack(self, selective):
+        sack = self.sack
+        packet = bytearray(sack.size * len(selective))
+        for index, seq in enumerate(sorted(selective)):
+            sack.pack_into(packet, index * sack.size, seq)
+        return packet
+
+    # The selectively acknowledged sequence numbers in an ACK payload
+    def parse_sack(self, payload):
+        count = len(payload) // self.sack.size
+        return [seq for seq, in self.sack.iter_unpack(payload[:count * self.sack.size])]
+
+
+# The protocol itself - packet types, header layout, states, tuning constants, and everything about a
+# connection that does not care how its datagrams get on and off the wire. RDTOverUDP runs it over a
+# blocking socket, and AsyncRDTConnection (async_reliable_UDP.py) on an asyncio event loop.
+class RDTProtocol:
     # Packet types
     PACKET_TYPE_CONNECT = 0x01
     PACKET_TYPE_SYNACK = 0x02
@@ -23,8 +440,29 @@ class RDTOverUDP:
     DISABLE_FLAG = 0x00
     ENABLE_FLAG = 0x01
 
+    # The original header - see HeaderCodec for the others
     HEADER_FORMAT = "!BIIBB"
     HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+    # DATA and ACK packets also carry the sender's receive window once both ends have offered one.
+    # Everything else keeps the original header, so a peer can always read the handshake.
+    MAX_RECEIVE_WINDOW = 0xFFFF
+    # Stream ids are 16 bits on the wire
+    MAX_STREAM = 0xFFFF
+    # Newest wire format we know (see HeaderCodec) - both ends use the newest one they both offer
+    WIRE_VERSION = 2
+
+    # Handshake options are sent as name=value pairs in the CONNECT and SYNACK payloads
+    OPTION_SEGMENT_SIZE = "segment_size"
+    OPTION_RECEIVE_WINDOW = "receive_window"
+    OPTION_DELAYED_ACK = "delayed_ack"
+    # The server's resumption token - in a SYNACK it is a new one, in a CONNECT the client is presenting
+    # the one it was given last time. A SYNACK with resumed set took the token, so no handshake ACK follows.
+    OPTION_TOKEN = "token"
+    OPTION_RESUMED = "resumed"
+    OPTION_STREAMS = "streams"
+    OPTION_VERSION = "version"
+    # A resuming client's first DATA segment follows the CONNECT options after this byte
+    EARLY_DATA_SEPARATOR = b"\0"
 
     # Server states
     STATE_LISTEN = "LISTEN"
@@ -44,26 +482,350 @@ class RDTOverUDP:
 
     # Other constants
     CONNECT_RETRY = 3
-    UDP_BUFFER = 1024
+    # Large enough for any UDP datagram, whatever segment size gets negotiated
+    UDP_BUFFER = 65535
+    # Segment size used with peers that do not negotiate one during the handshake
     SEND_BYTE_SIZE = 8
-    # how long we listen before timing out and resending
+    # Default maximum segment size - keeps header + payload inside the 1280 byte IPv6 minimum MTU
+    DEFAULT_SEGMENT_SIZE = 1200
+    # how long we listen before timing out and resending, until we have measured the round trip
     TIMEOUT = 1.0
-    # likelihood of a packet drop happening (affects data and ack packets)
-    DROP_CHANCE = 0.25
-    # TIMEOUT multiplier when switching roles between send/receive
+    # ACKs that report later segments but not the oldest one before we resend it early
+    DUP_ACK_THRESHOLD = 3
+    # shortest socket timeout used while waiting on several segment timers
+    MIN_WAIT = 0.001
+    # TIMEOUT multiplier for the quiet period we still wait out after a final segment from a legacy peer
     COOLDOWN_MULTIPLIER = 3
 
-    # Initialize variables on creation
-    def __init__(self, host, port):
+    # With delayed ACKs, in-order segments are acknowledged every DELAYED_ACK_SEGMENTS segments, or
+    # DELAYED_ACK_TIMEOUT seconds after the first one (kept under RTTEstimator.MIN_RTO, so a held back
+    # ACK never looks like a loss), unless DATA we send carries the ACK number first
+    DELAYED_ACK_SEGMENTS = 2
+    DELAYED_ACK_TIMEOUT = 0.01
+    # Datagrams read from the socket per wakeup, each into its own preallocated buffer
+    RECV_BATCH = 32
+    # Room in each receive buffer beyond the largest segment we offer - handshake options and SACK lists
+    RECV_SLACK = 1024
+
+    # Initialize the state both transports share.
+    # window_size is the number of unacknowledged segments allowed in flight, and the number of
+    # out-of-order segments we buffer when receiving. 1 is classic stop-and-wait.
+    # segment_size is the largest payload we offer to put in one packet; both ends settle on the
+    # smaller of their two offers while connecting.
+    # trace is an optional PacketTrace that records every packet we send, receive or drop.
+    # link is what actually puts our datagrams on the wire - a DirectLink unless we are testing.
+    # delayed_ack holds back ACKs for in-order DATA so they can be combined, or ride along on our reply.
+    # tokens is the server's ResumptionTokens (a listener or server shares one between its connections), and
+    # session is a Session from an earlier connection to the same server that a client can resume.
+    # streams offers the peer several independent streams of messages over the one connection.
+    # wire_version is the newest header format we offer - 1 to stick to the original one.
+    def __init__(self, host, port, window_size=1, segment_size=DEFAULT_SEGMENT_SIZE, trace=None, link=None,
+                 delayed_ack=False, tokens=None, session=None, streams=False, wire_version=WIRE_VERSION):
         self.host = host
         self.port = port
+        self.window_size = max(1, window_size)
+        self.max_segment_size = segment_size
+        self.segment_size = segment_size # Negotiated with the peer during the handshake
         self.state = self.STATE_INIT
+        self.counters = ConnectionStats(self.state) # What stats() reports
         self.seq_num = 0 # Holds local sequence number
         self.ack_num = 0 # Holds remote sequence number +1
+        self.rtt = RTTEstimator(self.TIMEOUT)
+        self.legacy_peer = False # Peer sent no handshake options, so it predates the final-segment handshake
+        self.congestion = CongestionControl(self.window_size)
+        self.rwnd = self.window_size # Segments the peer last told us it has room for
+        self.extended_header = False # Both ends offered a receive window, so DATA and ACK headers carry one
+        self.wire_version = wire_version
+        self.codec = HeaderCodec() # Packs and parses our headers - replaced once the handshake settles the format
+        self.peer_delays_acks = False # The peer holds its ACKs back for its DATA to carry
+        self.out_of_order = {} # Segments received ahead of a gap, held until the gap is filled (Selective Repeat)
+        self.trace = trace
+        self.link = link if link is not None else DirectLink()
+        self.delayed_ack = delayed_ack
+        self.segments_unacked = 0 # In-order segments we have not acknowledged yet (delayed ACKs only)
+        self.ack_timer = None # Sends an ACK we are holding back once nothing else has carried it
+        self.tokens = tokens
+        self.session = session
+        # Streams - handshake and congestion state are shared, but every stream numbers its own
+        # segments and is put back in order on its own, so one stream never waits for another
+        self.streams = streams
+        self.stream_header = False # Both ends offered streams, so DATA carries its stream
+        self.next_stream = 0 # Last stream id open_stream handed out
+        self.stream_seqs = {} # Sending - next number in each stream
+        self.stream_next = {} # Receiving - number we expect next in each stream
+        self.stream_held = {} # Receiving - stream id -> {number in stream: sequence number} held in out_of_order
+        self.stream_buffers = {} # Receiving - the part of each stream's current message we already have
+        self.completed = deque() # Receiving - (stream, message) that came in whole while we were waiting for another
+
+    ###############################################
+    ##### Left to the transport ###################
+    ###############################################
+
+    # Give one in-order segment to whoever is receiving - ready is where this transport collects them
+    def hand_over(self, ready, stream, payload, final, length):
+        raise NotImplementedError
+
+    # (DATA packets waiting for an ACK, packets received but not looked at yet) - for stats
+    def queued(self):
+        raise NotImplementedError
+
+    # Port of the other end, for our trace
+    def peer_port(self):
+        raise NotImplementedError
+
+    ###############################################
+    ##### Streams #################################
+    ###############################################
+
+    # Gives a new stream id for sending. Ids only have to be unique in one direction, so a reply can go
+    # back on the stream its request came in on. There are only MAX_STREAM of them, and they are never reused.
+    def open_stream(self):
+        if not self.streams:
+            raise ValueError("streams are not enabled on this connection")
+        if self.next_stream == self.MAX_STREAM:
+            raise ValueError(f"all {self.MAX_STREAM} stream ids of this connection have been used")
+        self.next_stream += 1
+        return self.next_stream
+
+    # Forget a stream both ends are done with - its numbering, and what we kept to put it back in order.
+    # Neither end may send on it again. Raises ValueError while part of a message on it is still on its way.
+    def close_stream(self, stream):
+        if self.stream_held.get(stream) or self.stream_buffers.get(stream):
+            raise ValueError(f"stream {stream} still has a message on its way")
+        self.stream_seqs.pop(stream, None)
+        self.stream_next.pop(stream, None)
+        self.stream_held.pop(stream, None)
+
+    # Keep a segment we cannot hand over yet with the rest of its stream's message - length is the whole
+    # message's length if the header said (None if not)
+    def buffer_segment(self, stream, segment, final, length=None):
+        buffer = self.stream_buffers.get(stream)
+        if buffer is None:
+            buffer = self.stream_buffers[stream] = ReassemblyBuffer()
+        buffer.append(segment, length)
+        # A finished message takes its buffer with it - the next one on this stream starts a new one
+        if final:
+            del self.stream_buffers[stream]
+            self.completed.append((stream, buffer.take()))
+
+    ###############################################
+    ##### Receiving ###############################
+    ###############################################
+
+    # Put a DATA segment in order - segments that can be handed over go to ready, in order for their
+    # stream, see hand_over. True if it should be acknowledged straight away: it filled a gap, or it
+    # came early or again, so the peer hears about it quickly.
+    def accept_data(self, ready, seq_num, final, stream, length, payload):
+        # If the sequence number is correct, increment what we expect
+        if seq_num == self.ack_num:
+            self.ack_num = seq_num + 1
+            self.segments_unacked += 1
+            # Hand the data over - copied, since the receive buffer it sits in gets reused
+            self.deliver_segment(ready, bytes(payload), final, stream, length)
+            # Pull in any buffered segments the gap was holding back. Segments of other streams may
+            # have been handed over already, and only their place in the sequence is left.
+            gap_filled = False
+            while self.ack_num in self.out_of_order:
+                payload, final, stream, length = self.out_of_order.pop(self.ack_num)
+                self.ack_num += 1
+                gap_filled = True
+                if payload is not None:
+                    if stream is not None:
+                        self.stream_held[stream[0]].pop(stream[1], None)
+                    self.deliver_segment(ready, payload, final, stream, length)
+            return gap_filled
+        # Hold segments that fit in our window but arrived early - unless they are next in their
+        # own stream, when the gap in front of them is another stream's problem
+        if self.ack_num < seq_num < self.ack_num + self.window_size and seq_num not in self.out_of_order:
+            if stream is not None and stream[1] == self.stream_next.get(stream[0], 0):
+                self.out_of_order[seq_num] = (None, final, stream, length)
+                self.deliver_segment(ready, bytes(payload), final, stream, length)
+            else:
+                self.out_of_order[seq_num] = (bytes(payload), final, stream, length)
+                if stream is not None:
+                    self.stream_held.setdefault(stream[0], {})[stream[1]] = seq_num
+        # Anything else we already have - the peer missed our ACK
+        return True
+
+    # A segment is next in its stream, so it is handed over, along with any segments of the same
+    # stream that were held waiting for it
+    def deliver_segment(self, ready, payload, final, stream, length=None):
+        while True:
+            self.counters.data_bytes_received += len(payload)
+            self.hand_over(ready, 0 if stream is None else stream[0], payload, final == self.ENABLE_FLAG, length)
+            if stream is None:
+                return
+            stream_id, stream_seq = stream
+            self.stream_next[stream_id] = stream_seq + 1
+            held = self.stream_held.get(stream_id)
+            seq_num = held.pop(stream_seq + 1, None) if held else None
+            if seq_num is None:
+                return
+            # Only its place in the connection's sequence stays behind
+            payload, final, stream, length = self.out_of_order[seq_num]
+            self.out_of_order[seq_num] = (None, final, stream, length)
+
+    # Our ACK number just went out, so nothing is owed any more
+    def ack_sent(self):
+        self.segments_unacked = 0
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+
+    ###############################################
+    ##### Windows and stats #######################
+    ###############################################
+
+    # Segments we can still take past ack_num - the window less whatever is already held out of order
+    def receive_window(self):
+        return min(max(self.window_size - len(self.out_of_order), 0), self.MAX_RECEIVE_WINDOW)
+
+    # Segments we may have in flight - the smallest of our own window, the congestion window and the
+    # peer's receive window. One segment is always allowed so a full receiver still gets probed.
+    def send_window(self):
+        return max(1, min(self.window_size, self.congestion.window(), self.rwnd))
+
+    # Current congestion window, in segments
+    @property
+    def cwnd(self):
+        return self.congestion.cwnd
+
+    # Snapshot of how the connection is doing - the ConnectionStats counters plus the RTT estimate, windows
+    # and how much is queued up in it right now. All plain dicts and numbers, ready for json.dumps, and safe
+    # to call from another thread. ConnectionStats.merge adds up snapshots from many connections.
+    def stats(self):
+        snapshot = self.counters.snapshot()
+        snapshot.update(state=self.state, timeouts=self.rtt.timeouts, srtt=self.rtt.srtt, rto=self.rtt.rto,
+                        cwnd=self.congestion.cwnd, rwnd=self.rwnd, wire_version=self.codec.version)
+        unacked, received = self.queued()
+        snapshot["queues"] = {"unacked": unacked, "out_of_order": len(self.out_of_order),
+                              "received": received, "completed": len(self.completed)}
+        return snapshot
+
+    # Feed the round trip of a packet we sent at sent (time.monotonic) into the RTT estimator and our stats
+    def sample_rtt(self, sent):
+        rtt = time.monotonic() - sent
+        self.rtt.sample(rtt)
+        self.counters.rtt.add(rtt)
+
+    ###############################################
+    ##### Handshake ###############################
+    ###############################################
+
+    # Options we offer in our CONNECT (segment_size is our largest) or SYNACK (the one we settled on)
+    def handshake_options(self, segment_size):
+        options = {self.OPTION_SEGMENT_SIZE: segment_size, self.OPTION_RECEIVE_WINDOW: min(self.window_size, self.MAX_RECEIVE_WINDOW)}
+        if self.delayed_ack:
+            options[self.OPTION_DELAYED_ACK] = 1
+        if self.streams:
+            options[self.OPTION_STREAMS] = 1
+        if self.wire_version > 1:
+            options[self.OPTION_VERSION] = self.wire_version
+        return options
+
+    # Settle the connection on the options the peer sent - peers that do not offer a segment size get the
+    # legacy size, and peers that do not offer a receive window keep the original header. Legacy peers
+    # never buffer out of order, so we only ever send them one segment at a time.
+    # Raises ValueError if an option is not a number - nothing is changed, and the handshake is bad.
+    def negotiate(self, options):
+        legacy_peer = not options
+        segment_size = self.option_int(options, self.OPTION_SEGMENT_SIZE, self.SEND_BYTE_SIZE, 1, self.max_segment_size)
+        rwnd = self.option_int(options, self.OPTION_RECEIVE_WINDOW, 1 if legacy_peer else self.window_size, 1, self.MAX_RECEIVE_WINDOW)
+        # Peers that offer no version only know v1
+        version = self.option_int(options, self.OPTION_VERSION, 1, 1, self.wire_version)
+        self.legacy_peer = legacy_peer
+        self.segment_size = segment_size
+        self.extended_header = self.OPTION_RECEIVE_WINDOW in options
+        self.rwnd = rwnd
+        self.peer_delays_acks = self.OPTION_DELAYED_ACK in options
+        # Streams ride on the extended header. Every connection starts with nothing held out of order
+        # and numbers its streams from scratch.
+        self.stream_header = self.streams and self.extended_header and self.OPTION_STREAMS in options
+        self.codec = HeaderCodec(version, self.extended_header, self.stream_header)
+        self.out_of_order.clear()
+        self.stream_seqs.clear()
+        self.stream_next.clear()
+        self.stream_held.clear()
+
+    # Utility function to read a number from the peer's handshake options, kept between low and high
+    # (a segment size of 0 would never get anything sent). Missing options get the default.
+    @staticmethod
+    def option_int(options, name, default, low, high):
+        if name not in options:
+            return default
+        try:
+            value = int(options[name])
+        except ValueError:
+            raise ValueError(f"bad handshake option {name}={options[name]!r}") from None
+        return min(max(value, low), high)
+
+    # Utility function to build a handshake options payload, e.g. b"segment_size=1200"
+    # Options are plain ASCII so that older peers can still print the payload
+    @staticmethod
+    def pack_options(options):
+        return ";".join(f"{option}={value}" for option, value in options.items()).encode()
+
+    # Utility function to split a CONNECT payload into its options and any early data.
+    # Options are never binary, so the first separator byte is where the early data starts.
+    @classmethod
+    def split_connect(cls, payload):
+        payload = bytes(payload)
+        options, separator, early_data = payload.partition(cls.EARLY_DATA_SEPARATOR)
+        return options, (early_data if separator else None)
+
+    # Utility function to read handshake options - a peer that predates options just gives none
+    @staticmethod
+    def parse_options(payload):
+        options = {}
+        for option in bytes(payload).split(b";"):
+            name, _, value = option.partition(b"=")
+            if name and value:
+                options[name.decode(errors="replace")] = value.decode(errors="replace")
+        return options
+
+    # Record a packet in our trace - only called when tracing is on, so the extra parse is not on the normal path
+    def trace_packet(self, direction, packet):
+        packet_type, seq_num, ack_num, final, resent, rwnd, stream, length, payload = self.codec.parse(packet)
+        self.trace.record(direction, packet_type, seq_num, ack_num, final, resent, rwnd, len(payload), self.peer_port())
+
+    # Used to track FSM machine
+    def set_state(self, state):
+        self.state = state
+        self.counters.set_state(state)
+        logger.debug("Setting state to %s", state)
+
+
+# Class for managing reliable data transfer over UDP
+# This is a basic form of reliability for a class homework assignment
+# and not intended to be thorough! Do not use in production environment!
+class RDTOverUDP(RDTProtocol):
+    # Initialize variables on creation - see RDTProtocol for the options.
+    # listener and peer are set when an RDTListener creates us for one client on its shared socket.
+    def __init__(self, host, port, window_size=1, segment_size=RDTProtocol.DEFAULT_SEGMENT_SIZE, listener=None, peer=None, trace=None, link=None,
+                 delayed_ack=False, tokens=None, session=None, streams=False, wire_version=RDTProtocol.WIRE_VERSION):
+        super().__init__(host, port, window_size, segment_size, trace, link, delayed_ack, tokens, session, streams, wire_version)
         self.final = 0
         self.udp_socket = None
         self.client_address = host
+        self.listener = listener
+        self.inbox = None # Datagrams for us, queued by the listener
+        if listener is not None:
+            self.udp_socket = listener.udp_socket
+            self.client_address = peer
+            self.inbox = queue.Queue()
         self.cached_packet = None
+        self.unacked_packets = {} # Sent DATA packets waiting for an ACK, by sequence number
+        self.stashed_packets = deque() # Packets one loop received on behalf of another
+        self.handshake_ack = None # Client side - our handshake ACK, resent if the server repeats its SYNACK
+        # Receive buffers, allocated once and reused - received holds views of the datagrams read into
+        # them that nobody has asked for yet. Anything kept past the next read of RECV_BATCH datagrams is copied.
+        self.recv_buffers = None
+        self.recv_next = 0
+        self.received = deque()
+        self.ack_lock = threading.RLock() # The ACK timer runs on its own thread
+        self.handshake_synack = None # Server side - our SYNACK, resent if the client repeats its CONNECT once we are ESTABLISHED
+        self.early_data = None # Server side - (segment, final) that came in the CONNECT, waiting for rdt_receive
+        self.listening = False # Server side - we bound our own socket, and keep it between sessions
 
     #################################################################
     ##### Initialization functions differ for client and server #####
@@ -72,9 +834,20 @@ class RDTOverUDP:
     # Server initialization - this moves through the FSM to the ESTABLISHED connection state
     def rdt_server_wait_connect(self):
         retries = 0
-        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.udp_socket.bind((self.host, self.port))
+        # A listener's connections share its socket, and a server on its own keeps its socket from one
+        # session to the next (see stop_listening) - so clients can come back at any time
+        if self.udp_socket is None:
+            self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp_socket.bind((self.host, self.port))
+            self.udp_socket.setblocking(False)
+            self.listening = True
+        if self.tokens is None:
+            self.tokens = ResumptionTokens()
+        self.handshake_synack = None
+        self.early_data = None
         self.set_state(self.STATE_LISTEN)
+        # When our SYNACK went out, so its ACK can time the round trip - None once it has been resent
+        synack_sent = None
 
         # I did add a retry limit here. There is a bug because once when a handshaking ack
         # was dropped, the server hit the retry limit and bailed but the client kept trying to
@@ -82,8 +855,9 @@ class RDTOverUDP:
         # Loop through to handle sending the different packets until we are ESTABLISHED
         while not self.state == self.STATE_ESTABLISHED and not retries == self.CONNECT_RETRY:
 
-            # Wait for packet
-            packet_type, seq_num, ack_num, final, resent, payload = self.rdt_wait_for_packet()
+            # Wait for packet - once our SYNACK is out, only until it is due to be resent
+            timeout = self.rtt.rto if self.state == self.STATE_SYNACK_SENT else None
+            packet_type, seq_num, ack_num, final, resent, stream, length, payload = self.rdt_wait_for_packet(timeout)
 
             # If we receive a reset, it's handled the same regardless of state
             if packet_type == self.PACKET_TYPE_RESET:
@@ -95,9 +869,43 @@ class RDTOverUDP:
                     # We really only care if we are receiving a SYN request
                     if packet_type == self.PACKET_TYPE_CONNECT:
                         self.ack_num = seq_num + 1
-                        # Send a SYNACK packet
-                        self.rdt_send_packet(self.PACKET_TYPE_SYNACK, b"")
-                        self.set_state(self.STATE_SYNACK_SENT)
+                        # Agree on a segment size and receive window with the client
+                        options, early_data = self.split_connect(payload)
+                        options = self.parse_options(options)
+                        try:
+                            self.negotiate(options)
+                        except ValueError as error:
+                            # Garbage options are a bad packet - a listener's connection gives up on this
+                            # peer straight away, so it leaves the listener's table
+                            logger.warning("Bad CONNECT from %s: %s", self.client_address, error)
+                            self.rdt_send_packet(self.PACKET_TYPE_RESET, b"")
+                            self.do_reset()
+                            retries = self.CONNECT_RETRY if self.listener is not None else retries + 1
+                            continue
+                        synack_options = self.handshake_options(self.segment_size)
+                        host = self.client_address[0]
+                        # Clients that understand options get a token to come back with next time
+                        if not self.legacy_peer:
+                            synack_options[self.OPTION_TOKEN] = self.tokens.issue(host)
+                        # A client presenting a good token is ESTABLISHED as soon as we answer, and
+                        # any early data it sent along is ours - our SYNACK acknowledges it
+                        if self.tokens.check(options.get(self.OPTION_TOKEN, ""), host):
+                            synack_options[self.OPTION_RESUMED] = 1
+                            if early_data is not None:
+                                self.early_data = (bytes(early_data), final)
+                                self.ack_num += 1
+                            self.rdt_send_packet(self.PACKET_TYPE_SYNACK, self.pack_options(synack_options))
+                            self.handshake_synack = self.cached_packet
+                            self.set_state(self.STATE_ESTABLISHED)
+                        # Otherwise any early data is dropped - the client sends it again once we are connected
+                        else:
+                            self.rdt_send_packet(self.PACKET_TYPE_SYNACK, self.pack_options(synack_options))
+                            self.handshake_synack = self.cached_packet
+                            synack_sent = time.monotonic()
+                            self.set_state(self.STATE_SYNACK_SENT)
+                    # The client of the session we just closed missed our DISCONNECT_ACK
+                    elif packet_type == self.PACKET_TYPE_DISCONNECT:
+                        self.rdt_send_packet(self.PACKET_TYPE_DISCONNECT_ACK, b"")
                     # Anything else is unexpected, return a RESET
                     else:
                         self.rdt_send_packet(self.PACKET_TYPE_RESET, b"")
@@ -109,7 +917,27 @@ class RDTOverUDP:
                     if packet_type == self.PACKET_TYPE_ACK and ack_num == self.seq_num + 1:
                         self.set_state(self.STATE_ESTABLISHED)
                         self.ack_num = seq_num + 1
+                        # First RTT sample, so the connection does not start out on the initial timeout
+                        if synack_sent is not None and not resent:
+                            self.sample_rtt(synack_sent)
                         # No response necessary
+                    # If the handshake ACK was dropped, DATA that acknowledges our SYNACK proves the client
+                    # is ESTABLISHED. Its ACK used up the next sequence number, and the DATA is kept for rdt_receive.
+                    elif packet_type == self.PACKET_TYPE_DATA and ack_num == self.seq_num + 1:
+                        self.set_state(self.STATE_ESTABLISHED)
+                        self.ack_num += 1
+                        self.stashed_packets.append((packet_type, seq_num, ack_num, final, resent, stream, length, bytes(payload)))
+                    # The client resent its CONNECT, so our SYNACK was lost
+                    elif packet_type == self.PACKET_TYPE_CONNECT:
+                        self.rdt_send_packet(self.PACKET_TYPE_SYNACK, b"", resend=True)
+                        synack_sent = None
+                    # Nothing back - either our SYNACK or the client's ACK was lost
+                    elif packet_type == self.PACKET_TYPE_NONE:
+                        self.rtt.backoff()
+                        retries += 1
+                        if retries < self.CONNECT_RETRY:
+                            self.rdt_send_packet(self.PACKET_TYPE_SYNACK, b"", resend=True)
+                            synack_sent = None
                     # Anything else is unexpected, return a RESET
                     else:
                         self.rdt_send_packet(self.PACKET_TYPE_RESET, b"")
@@ -118,13 +946,24 @@ class RDTOverUDP:
                         retries += 1
         if retries == self.CONNECT_RETRY:
             self.set_state(self.STATE_CLOSED)
-            print(f"Failed to connect - connect retry limit reached")
+            self.close_socket()
+            logger.warning("Failed to connect - connect retry limit reached")
 
     # Client initialization - this moves through the FSM to the ESTABLISHED connection state
-    def rdt_client_connect(self):
+    # early_data is an optional first message. With a session to resume, its first segment goes out
+    # in the CONNECT itself (0-RTT) - it may be delivered more than once if the CONNECT is repeated
+    # to a new server, so only send early data that is safe to repeat. The rest of it, or all of it
+    # without a session, is sent with rdt_send once we are connected.
+    def rdt_client_connect(self, early_data=None):
         self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.setblocking(False)
+        self.received.clear()
         self.set_state(self.STATE_INIT)
         retries = 0
+        # Bytes of early_data that went out in the CONNECT
+        early_sent = 0
+        # When our CONNECT went out, so the SYNACK can time the round trip - None once it has been resent
+        connect_sent = None
 
         # Retry limit has a bug, but it wasn't a requirement for the assignment so... :shrug:
         # Loop through to handle sending the different packets until ESTABLISHED
@@ -132,83 +971,202 @@ class RDTOverUDP:
 
             # Send CONNECT or ACK depending on state
             if self.state == self.STATE_INIT:
-                self.rdt_send_packet(self.PACKET_TYPE_CONNECT, b"")
+                options = self.handshake_options(self.max_segment_size)
+                payload = b""
+                if self.session is not None:
+                    options[self.OPTION_TOKEN] = self.session.token
+                    if early_data:
+                        payload = bytes(memoryview(early_data)[:self.session.segment_size])
+                        early_sent = len(payload)
+                if early_sent:
+                    payload = self.pack_options(options) + self.EARLY_DATA_SEPARATOR + payload
+                    self.rdt_send_packet(self.PACKET_TYPE_CONNECT, payload, final=early_sent == len(early_data))
+                else:
+                    self.rdt_send_packet(self.PACKET_TYPE_CONNECT, self.pack_options(options))
+                # A SYNACK after a RESET may answer either CONNECT, so only the first one is timed
+                connect_sent = time.monotonic() if not retries else None
                 self.set_state(self.STATE_SYN_REQUESTED)
             if self.state == self.STATE_SYNACK_RECEIVED:
                 self.rdt_send_packet(self.PACKET_TYPE_ACK, b"")
+                self.handshake_ack = self.cached_packet
                 self.set_state(self.STATE_ESTABLISHED)
 
             # Listen for response and update state
             if self.state == self.STATE_SYN_REQUESTED:
-                packet_type, seq_num, ack_num, final, resent, payload = self.rdt_wait_for_packet()
-                # Receive options
-                if packet_type == self.PACKET_TYPE_SYNACK and ack_num == self.seq_num + 1:
+                packet_type, seq_num, ack_num, final, resent, stream, length, payload = self.rdt_wait_for_packet(self.rtt.rto)
+                # Receive options - a resumed SYNACK also acknowledges our early data
+                options = self.parse_options(payload) if packet_type == self.PACKET_TYPE_SYNACK else {}
+                resumed = self.OPTION_RESUMED in options
+                if packet_type == self.PACKET_TYPE_SYNACK and ack_num == self.seq_num + 1 + (resumed and early_sent > 0):
                     # Handshake complete, move on!
                     self.ack_num = seq_num + 1
-                    self.rdt_send_packet(self.PACKET_TYPE_ACK, b"")
+                    # First RTT sample, so the connection does not start out on the initial timeout
+                    if connect_sent is not None and not resent:
+                        self.sample_rtt(connect_sent)
+                    # Use the segment size the server settled on - legacy servers do not send one
+                    try:
+                        self.negotiate(options)
+                    except ValueError as error:
+                        # A server sending garbage options is not one we can talk to
+                        logger.warning("Bad SYNACK: %s", error)
+                        self.rdt_send_packet(self.PACKET_TYPE_RESET, b"")
+                        self.set_state(self.STATE_CLOSED)
+                        self.close_socket()
+                        break
+                    if self.OPTION_TOKEN in options:
+                        self.session = Session(options[self.OPTION_TOKEN], self.segment_size)
+                    # The server took our token, so it is already ESTABLISHED and needs no ACK
+                    if resumed:
+                        self.seq_num += early_sent > 0
+                        self.handshake_ack = None
+                        # Our early data was the first segment of stream 0
+                        if early_sent and self.stream_header:
+                            self.stream_seqs[0] = 1
+                    else:
+                        self.rdt_send_packet(self.PACKET_TYPE_ACK, b"")
+                        self.handshake_ack = self.cached_packet
+                        early_sent = 0
                     self.set_state(self.STATE_ESTABLISHED)
                     #self.seq_num = 0 # intentional for tracking data from the first segment
                 elif packet_type == self.PACKET_TYPE_RESET:
                     self.do_reset()
+                # Nothing back - our CONNECT or the SYNACK was lost, so try again
+                elif packet_type == self.PACKET_TYPE_NONE:
+                    self.rtt.backoff()
+                    retries += 1
+                    if retries < self.CONNECT_RETRY:
+                        self.rdt_send_packet(self.PACKET_TYPE_CONNECT, b"", resend=True)
+                        connect_sent = None
+                # A resumed server already answering our early data - we missed its SYNACK, which
+                # it sends again when our CONNECT repeats, and the DATA comes round again after that
+                elif packet_type == self.PACKET_TYPE_DATA and early_sent:
+                    pass
                 else:
                     # Unexpected response, send reset
                     self.rdt_send_packet(self.PACKET_TYPE_RESET, b"")
                     self.set_state(self.STATE_INIT)
                     retries += 1
 
+        # Whatever of the first message did not go in the CONNECT
+        if early_data and self.state == self.STATE_ESTABLISHED and early_sent < len(early_data):
+            self.rdt_send(memoryview(early_data)[early_sent:])
+
     # Teardown function is shared between client and server
+    # We give up after CONNECT_RETRY unanswered DISCONNECTs - the peer may already be gone
     def close(self):
+        # Don't leave the peer waiting on an ACK we were holding back
+        if self.segments_unacked:
+            self.rdt_send_ack()
+        retries = 0
         while self.state != self.STATE_CLOSED:
             self.set_state(self.STATE_CLOSE_WAIT)
             self.rdt_send_packet(self.PACKET_TYPE_DISCONNECT, b"")
-            packet_type, seq_num, ack_num, final, resent, payload = self.rdt_wait_for_packet()
+            packet_type, seq_num, ack_num, final, resent, stream, length, payload = self.rdt_wait_for_packet(self.rtt.rto)
             if packet_type == self.PACKET_TYPE_DISCONNECT_ACK:
                 self.set_state(self.STATE_CLOSED)
-        self.udp_socket.close()
+            elif packet_type == self.PACKET_TYPE_NONE:
+                self.rtt.backoff()
+                retries += 1
+                if retries == self.CONNECT_RETRY:
+                    self.set_state(self.STATE_CLOSED)
+            # The peer may still be resending a final segment whose ACK it never got
+            elif packet_type == self.PACKET_TYPE_DATA:
+                self.rdt_send_ack()
+        self.close_socket()
 
     ##############################
     ##### Reliable functions #####
     ##############################
 
-    # The reliable receive function handles FSM states from ESTABLISHED to CLOSED
+    # The reliable receive function - waits for one whole message and gives it back
+    # (b"" if the connection is closed instead)
     def rdt_receive(self):
-        print('Listening for data')
+        return self.rdt_receive_message()[1]
+
+    # Receive for connections with streams - waits for the next message to finish on any stream and gives
+    # back (stream, message), or (0, b"") once the connection is closed. Messages on one stream come in
+    # the order they were sent, but a message never waits for segments of another stream.
+    def rdt_receive_message(self):
+        while not self.completed and not self.state == self.STATE_CLOSED:
+            for stream, segment, final, length in self.receive_segments():
+                self.buffer_segment(stream, segment, final, length)
+        return self.completed.popleft() if self.completed else (0, b"")
+
+    # Every message that has already come in whole, as (stream, message), without waiting for more -
+    # a server can answer all of them with one rdt_send_many
+    def rdt_receive_waiting(self):
+        messages = list(self.completed)
+        self.completed.clear()
+        return messages
+
+    # Streaming receive - yields the segments of one message in order as they arrive, so a large
+    # message never has to be held in memory at once. Iterate to the end: the message is over when the
+    # iterator is. With streams, it is the next message to start arriving - segments of other streams
+    # are kept for rdt_receive_message.
+    #     for segment in connection.rdt_receive_stream():
+    #         out_file.write(segment)
+    def rdt_receive_stream(self):
+        # A message that came in whole while we were waiting for another
+        if self.completed:
+            yield self.completed.popleft()[1]
+            return
+        target = None
+        done = False
+        while not done and not self.state == self.STATE_CLOSED:
+            for stream, segment, final, length in self.receive_segments():
+                if target is None:
+                    target = stream
+                    # Whatever we already have of its message comes first
+                    buffer = self.stream_buffers.pop(stream, None)
+                    if buffer:
+                        yield buffer.take(partial=True)
+                if stream == target and not done:
+                    yield segment
+                    done = final
+                else:
+                    self.buffer_segment(stream, segment, final, length)
+
+    # Handles FSM states from ESTABLISHED to CLOSED and yields (stream, segment, final, length) for segments as
+    # they can be handed over, in order for their stream, until a message is complete
+    def receive_segments(self):
+        logger.debug("Listening for data")
         # We should already have an established connection
-        data_complete = False
-        buffer = b''
+        # Segments we can hand over, and whether the peer needs an ACK as soon as we have
+        # handled every datagram that arrived with this one
+        ready = []
+        ack_now = False
+        # When a delayed ACK has to go out even if nothing else arrives
+        ack_deadline = None
+        # The start of a message may have come in with a resumed CONNECT
+        self.take_early_data(ready)
+        yield from ready
+        ready = []
 
         # Operational loop for reliable receive
         while not self.final and not self.state == self.STATE_CLOSED:
 
-            # Get a packet
-            packet_type, seq_num, ack_num, final, resent, payload = self.rdt_wait_for_packet()
+            # Get a packet - only until a delayed ACK is due
+            timeout = None if ack_deadline is None else max(ack_deadline - time.monotonic(), 0)
+            packet_type, seq_num, ack_num, final, resent, stream, length, payload = self.rdt_wait_for_packet(timeout)
 
             # State machine handling
             if self.state == self.STATE_ESTABLISHED:
                 # If we have data...
                 if packet_type == self.PACKET_TYPE_DATA:
-                    # If the sequence number is correct, increment what we expect
-                    if seq_num == self.ack_num:
-                        self.ack_num = seq_num + 1
-                        # Buffer the data
-                        buffer += payload
-                        # Set variable to break out of while loop and return data to caller
-                        if final == self.ENABLE_FLAG:
-                            self.final = 1
-                        # Send ack (this will be a re-ack for the previous packet if the numbers don't match)
-                        self.rdt_send_packet(self.PACKET_TYPE_ACK, b"", final=self.final)
-
-                        # Allow a cooldown period on final in case the sender does not receive ack, where it can retry
-                        # Note this can still fail if the sender has enough repeated dropped packets
-                        if self.final == 1:
-                            while packet_type != self.PACKET_TYPE_NONE:
-                                print("Cooldown...")
-                                packet_type, seq_num, ack_num, final, resent, payload = self.rdt_wait_for_packet(self.TIMEOUT * self.COOLDOWN_MULTIPLIER)
-                                if packet_type == self.PACKET_TYPE_DATA:
-                                    self.rdt_send_packet(self.PACKET_TYPE_ACK, b"", final=self.final)
-                    else:
-                        # If the seq is wrong, our ack may have timed out - resend
-                        self.rdt_send_packet(self.PACKET_TYPE_ACK, b"",resend=True)
+                    # The final flag breaks us out of the while loop once the caller has the data
+                    if self.accept_data(ready, seq_num, final, stream, length, payload):
+                        ack_now = True
+                    # ACK - cumulative up to ack_num, plus any segments we hold past a gap
+                    # (this will be a re-ack for the previous packet if the numbers don't match)
+                    # Without delayed ACKs (and always for legacy peers) every segment is acknowledged.
+                    # With them, the end of a message is held for our reply to carry, and anything else
+                    # every few segments - or every segment, if our window would stall the sender otherwise.
+                    if not self.delayed_ack or self.legacy_peer:
+                        ack_now = True
+                    elif not self.final and self.segments_unacked >= min(self.DELAYED_ACK_SEGMENTS, self.window_size):
+                        ack_now = True
+                    elif ack_deadline is None:
+                        ack_deadline = time.monotonic() + self.DELAYED_ACK_TIMEOUT
                 # Handle disconnect
                 elif packet_type == self.PACKET_TYPE_DISCONNECT:
                     self.set_state(self.STATE_CLOSE_WAIT)
@@ -219,11 +1177,22 @@ class RDTOverUDP:
                     # receive a close during data send.
                     self.rdt_send_packet(self.PACKET_TYPE_DISCONNECT_ACK, b"")
                     self.set_state(self.STATE_CLOSED)
-                    self.udp_socket.close()
+                    self.close_socket()
+                    ack_now = False
                 elif packet_type == self.PACKET_TYPE_RESET:
                     self.do_reset()
                 elif packet_type == self.PACKET_TYPE_ACK:
-                    continue
+                    pass
+                # The server is repeating its SYNACK, so it never got our handshake ACK
+                elif packet_type == self.PACKET_TYPE_SYNACK and self.handshake_ack is not None:
+                    self.send_packet(self.handshake_ack)
+                # The client is repeating its CONNECT - a resumed client never got our SYNACK, or the network
+                # held on to (or duplicated) a CONNECT that was already answered
+                elif packet_type == self.PACKET_TYPE_CONNECT and self.handshake_synack is not None:
+                    self.send_packet(self.handshake_synack)
+                # Our delayed ACK is due
+                elif packet_type == self.PACKET_TYPE_NONE:
+                    ack_now = ack_deadline is not None
                 # Anything else is either unexpected or a reset
                 else:
                     self.rdt_send_packet(self.PACKET_TYPE_RESET, b"")
@@ -232,147 +1201,640 @@ class RDTOverUDP:
             # Auto-reconnect
             else:
                 self.rdt_server_wait_connect()
-        # Opted to reset header bits for each new message
+                self.take_early_data(ready)
+
+            # One ACK covers every datagram that arrived together, so it goes out once we have worked
+            # through all of them (or straight away for the final segment).
+            # There is no cooldown after the final segment: if this ACK is lost, the resent final
+            # is re-acked by whichever loop we are in next, and our next DATA acknowledges it too.
+            if ack_now and (self.final or not self.packets_waiting()):
+                self.rdt_send_ack(self.out_of_order)
+                ack_now = False
+                ack_deadline = None
+                # A legacy sender cannot cope with our DATA before it has its final ACK, so for those
+                # we still wait out a cooldown period in which it can retry
+                if self.final == 1 and self.legacy_peer:
+                    while packet_type != self.PACKET_TYPE_NONE:
+                        logger.debug("Cooldown...")
+                        packet_type, seq_num, ack_num, final, resent, stream, length, payload = self.rdt_wait_for_packet(self.TIMEOUT * self.COOLDOWN_MULTIPLIER)
+                        if packet_type == self.PACKET_TYPE_DATA:
+                            self.rdt_send_ack()
+            # Only now, with any urgent ACK already sent, does the caller get to work on the data
+            if ready and not ack_now:
+                yield from ready
+                ready = []
+        # The ACK for the end of a message is held back in case our reply can carry it - if we
+        # have not sent anything by the time it is due, the timer sends it on its own
+        if self.segments_unacked and self.state == self.STATE_ESTABLISHED:
+            with self.ack_lock:
+                self.ack_timer = threading.Timer(self.DELAYED_ACK_TIMEOUT, self.send_delayed_ack)
+                self.ack_timer.daemon = True
+                self.ack_timer.start()
+        # Opted to reset header bits for each new message. With streams, out_of_order may still hold
+        # segments of other streams for the next call.
         self.do_reset()
-        return buffer
 
     # Reliable layer for lower level packet receive
+    # Gives (packet_type, seq_num, ack_num, final, resent, stream, length, payload) - see HeaderCodec.parse
     def rdt_wait_for_packet(self, timeout=None):
-        data = self.wait_for_packet(timeout)
-        if data is None:
-            return self.PACKET_TYPE_NONE, 0, 0, 0, b"", self.DISABLE_FLAG
-        else:
+        # Packets set aside by another loop are handled first
+        if self.stashed_packets:
+            return self.stashed_packets.popleft()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            data = self.wait_for_packet(timeout)
+            if data is None:
+                return self.PACKET_TYPE_NONE, 0, 0, 0, self.DISABLE_FLAG, None, None, b""
+            self.counters.packets_received += 1
+            self.counters.bytes_received += len(data)
             # Split out and parse header
-            header = data[:self.HEADER_SIZE]
-            payload = data[self.HEADER_SIZE:]
-            packet_type, seq_num, ack_num, final, resent = struct.unpack(self.HEADER_FORMAT, header)
-            print(
-                f"Received packet type {packet_type} with sequence {seq_num}, ack {ack_num}, final {final}, payload '{payload.decode()}'")
-            return packet_type, seq_num, ack_num, final, resent, payload
-
-    # The reliable send function handles FSM states from ESTABLISHED to CLOSED
-    def rdt_send(self, payload):
-        print('Sending data...')
-        # Split the payload into smaller packets if necessary
-        packets = self.split_payload(payload)
-        sent = 0
-        # resend is used to avoid the auto-increment of the seq
-        resend = False
-        while sent < len(packets):
+            header = self.codec.parse(data)
+            if header is not None:
+                break
+            # Too short or corrupted - as good as lost, so keep waiting for the rest of our timeout
+            logger.debug("Dropped corrupt packet")
+            self.counters.corrupt_received += 1
+            if deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0)
+        packet_type, seq_num, ack_num, final, resent, rwnd, stream, length, payload = header
+        if packet_type == self.PACKET_TYPE_RESET:
+            self.counters.resets_received += 1
+        # Keep track of how much room the peer says it has left
+        if rwnd is not None:
+            self.rwnd = rwnd
+        logger.debug("Received packet type %d with sequence %d, ack %d, final %d, %d byte payload",
+                     packet_type, seq_num, ack_num, final, len(payload))
+        if self.trace is not None:
+            self.trace_packet(PacketTrace.RECEIVED, data)
+        return packet_type, seq_num, ack_num, final, resent, stream, length, payload
+
+    # The reliable send function - sends one message, on stream if we have agreed to streams
+    def rdt_send(self, payload, stream=0):
+        self.rdt_send_many([(stream, payload)])
+
+    # Sends a list of (stream, message) and returns once all of them are acknowledged.
+    # Handles FSM states from ESTABLISHED to CLOSED.
+    # Up to window_size segments are in flight at once, each with its own resend timer
+    # (Selective Repeat). With window_size=1 this is plain stop-and-wait.
+    # Messages on different streams are sent side by side, a segment of each in turn, so a lost
+    # segment only holds up its own stream at the other end. Messages on one stream go one after another.
+    def rdt_send_many(self, messages):
+        logger.debug("Sending data...")
+        if not self.stream_header and any(stream != 0 for stream, payload in messages):
+            raise ValueError("streams were not agreed with the peer")
+        if any(not 0 <= stream <= self.MAX_STREAM for stream, payload in messages):
+            raise ValueError(f"stream ids go from 0 to {self.MAX_STREAM}")
+        # Split the payloads into smaller packets if necessary - these are handed out lazily
+        packets = self.interleave_segments(messages)
+        total = sum(-(-len(payload) // self.segment_size) for stream, payload in messages)
+        # Packet indexes of every message, in order, as they go out
+        message_packets = [[] for _ in messages]
+        # base is the oldest unacknowledged packet, next_packet is the next one to go out
+        base = 0
+        next_packet = 0
+        # Packets are numbered consecutively from the first one we send
+        first_seq = self.seq_num + 1
+        acked = [False] * total
+        # Resend deadline for every packet in flight, by packet index
+        timers = {}
+        # First send time of packets that have not been resent, for RTT samples
+        send_times = {}
+        # ACKs that did not move the window, and packets already fast-retransmitted
+        dup_acks = 0
+        fast_resent = set()
+        # The peer's DATA that we took in while sending needs an ACK that our own DATA cannot carry
+        ack_owed = False
+        while base < total:
             if self.state == self.STATE_ESTABLISHED:
-                # Send the packet
-                if sent == len(packets) - 1:
-                    self.rdt_send_packet(self.PACKET_TYPE_DATA, packets[sent], self.ENABLE_FLAG, resend=resend)
-                    self.final = 1
-                else:
-                    self.rdt_send_packet(self.PACKET_TYPE_DATA, packets[sent], resend=resend)
-                # Wait for the ACK - The TIMEOUT parameter is used for triggering a resend on dropped packets
-                packet_type, seq_num, ack_num, final, resent, payload = self.rdt_wait_for_packet(self.TIMEOUT)
+                # Fill the window - once we have seen every ACK that is already waiting, so the window
+                # slides as far as it can and the new segments go out together in one burst
+                while next_packet < total and next_packet < base + self.send_window() and not self.packets_waiting():
+                    index, stream, segment, final, length = next(packets)
+                    message_packets[index].append(next_packet)
+                    if self.stream_header:
+                        stream_seq = self.stream_seqs.get(stream, 0)
+                        self.stream_seqs[stream] = stream_seq + 1
+                        stream = (stream, stream_seq)
+                    else:
+                        stream = None
+                    self.rdt_send_packet(self.PACKET_TYPE_DATA, segment, final, stream=stream, length=length)
+                    if next_packet == total - 1:
+                        self.final = 1
+                    send_times[next_packet] = time.monotonic()
+                    timers[next_packet] = send_times[next_packet] + self.rtt.rto
+                    next_packet += 1
+                # Acknowledge whatever we took in from the peer that none of our DATA carried an ACK for
+                if (ack_owed or self.segments_unacked) and not self.packets_waiting():
+                    self.rdt_send_ack(self.out_of_order)
+                    ack_owed = False
+
+                # Wait for ACKs - we only listen until the earliest resend deadline
+                timeout = max(min(timers.values()) - time.monotonic(), self.MIN_WAIT) if timers else 0
+                packet_type, seq_num, ack_num, final, resent, stream, length, payload = self.rdt_wait_for_packet(timeout)
 
                 # Check the ACK
-                # Resend on dropped packets
+                newly_acked = []
                 if packet_type == self.PACKET_TYPE_NONE:
-                    print(f"Listen timed out")
-                    resend = True
+                    logger.debug("Listen timed out")
                 elif packet_type == self.PACKET_TYPE_ACK:
-                    if ack_num == self.seq_num + 1:
-                        # Good ack, increment to next packet
-                        resend = False
-                        sent += 1
+                    # ack_num covers everything before it, the payload lists segments held past a gap
+                    selective = [sack - first_seq for sack in self.codec.parse_sack(payload)]
+                    for index in list(range(base, min(ack_num - first_seq, next_packet))) + selective:
+                        if base <= index < next_packet and not acked[index]:
+                            acked[index] = True
+                            newly_acked.append(index)
+                    if not newly_acked:
+                        logger.debug("Received ack:%d, but expected %d -- ignoring", ack_num, first_seq + base + 1)
+                # The client is repeating its CONNECT - a resumed client never got our SYNACK, or the network
+                # held on to (or duplicated) a CONNECT that was already answered
+                elif packet_type == self.PACKET_TYPE_CONNECT and self.handshake_synack is not None:
+                    self.send_packet(self.handshake_synack)
+                # The peer is closing - it has everything before its ack_num, and will never take the rest
+                elif packet_type == self.PACKET_TYPE_DISCONNECT:
+                    self.rdt_send_packet(self.PACKET_TYPE_DISCONNECT_ACK, b"")
+                    self.set_state(self.STATE_CLOSED)
+                    self.unacked_packets.clear()
+                    self.close_socket()
+                    self.do_reset()
+                    return
+                # The peer has thrown the connection away, so nothing we send will ever be acknowledged
+                elif packet_type == self.PACKET_TYPE_RESET:
+                    logger.warning("Connection reset by peer - giving up on the send")
+                    self.set_state(self.STATE_CLOSED)
+                    self.unacked_packets.clear()
+                    self.close_socket()
+                    self.do_reset()
+                    return
+                elif packet_type == self.PACKET_TYPE_DATA:
+                    if seq_num < self.ack_num and self.legacy_peer:
+                        # The peer is resending something we already have - our ACK was lost
+                        self.rdt_send_ack()
+                    else:
+                        if self.legacy_peer:
+                            # The peer has moved on to its next message. Keep the DATA for rdt_receive
+                            # (copied out of the reused receive buffer). It may have spent sequence
+                            # numbers on ACKs we never saw.
+                            self.stashed_packets.append((packet_type, seq_num, ack_num, final, resent, stream, length, bytes(payload)))
+                            self.ack_num = seq_num
+                        else:
+                            # The peer is sending too - take its data in now, so neither of us waits on
+                            # the other, and keep the messages for rdt_receive
+                            ready = []
+                            if self.accept_data(ready, seq_num, final, stream, length, payload):
+                                ack_owed = True
+                            for segment in ready:
+                                self.buffer_segment(*segment)
+                        # Either way it has all of ours up to its ack_num
+                        for index in range(base, min(ack_num - first_seq, next_packet)):
+                            if not acked[index]:
+                                acked[index] = True
+                                newly_acked.append(index)
+
+                advanced = False
+                if newly_acked:
+                    # Legacy receivers spend a sequence number on every ACK, so their next DATA follows it
+                    if packet_type == self.PACKET_TYPE_ACK and self.legacy_peer:
                         self.ack_num = seq_num + 1
-                        # If that was the last packet, reset ack/seq values - an unnecessary choice on my part
-                        if self.final:
-                            self.do_reset()
+                    # Time the round trip off the newest packet this ACK covers, if it was only sent once.
+                    # DATA that acknowledges us goes out whenever the peer's application gets round to
+                    # it, so only real ACKs are timed - unless the peer delays its ACKs, when its DATA
+                    # never goes out later than the ACK would have. Not if it is resent DATA, though:
+                    # then it went out a whole timeout later (Karn's rule).
+                    timed = packet_type == self.PACKET_TYPE_ACK or (self.peer_delays_acks and not resent)
+                    sample = send_times.get(max(newly_acked)) if timed else None
+                    if sample is not None:
+                        self.sample_rtt(sample)
                     else:
-                        # resend on out-of-order packets
-                        print(f"Received ack:{ack_num}, but expected {self.seq_num + 1} -- resending")
-                        resend = True
+                        self.rtt.restore()
+                    self.congestion.on_ack(len(newly_acked))
+                    for index in newly_acked:
+                        timers.pop(index)
+                        send_times.pop(index, None)
+                        self.unacked_packets.pop(first_seq + index, None)
+                    # Slide the window past everything acknowledged
+                    if acked[base]:
+                        advanced = True
+                        dup_acks = 0
+                        while base < next_packet and acked[base]:
+                            base += 1
+                if packet_type == self.PACKET_TYPE_ACK and not advanced and base < next_packet:
+                    # The oldest packet is still missing while ACKs keep arriving - it was probably lost
+                    dup_acks += 1
+                    self.counters.dup_acks += 1
+                    if dup_acks >= self.DUP_ACK_THRESHOLD and base not in fast_resent:
+                        logger.debug("Fast retransmit of sequence %d", first_seq + base)
+                        fast_resent.add(base)
+                        self.congestion.on_loss()
+                        send_times.pop(base, None)
+                        self.rdt_send_packet(self.PACKET_TYPE_DATA, b"", resend=True, seq_num=first_seq + base)
+                        timers[base] = time.monotonic() + self.rtt.rto
+
+                # Resend every packet whose timer has run out, backing off the timeout
+                now = time.monotonic()
+                expired = [index for index, deadline in timers.items() if deadline <= now]
+                if expired:
+                    self.rtt.backoff()
+                    self.congestion.on_timeout()
+                for index in expired:
+                    send_times.pop(index, None)
+                    self.rdt_send_packet(self.PACKET_TYPE_DATA, b"", resend=True, seq_num=first_seq + index)
+                    timers[index] = now + self.rtt.rto
+                # If that was the last packet, reset ack/seq values - an unnecessary choice on my part
+                if base == total:
+                    if ack_owed or self.segments_unacked:
+                        self.rdt_send_ack(self.out_of_order)
+                    self.do_reset()
             else:
-                # Auto-reconnect
+                # Auto-reconnect, then start every message over from its first unacknowledged byte
+                # (the new connection may have settled on a different segment size).
+                # If we can resume the session, the first segment of a lone message goes in the CONNECT.
+                self.unacked_packets.clear()
+                remaining = []
+                for (stream, payload), indexes in zip(messages, message_packets):
+                    done = 0
+                    while done < len(indexes) and acked[indexes[done]]:
+                        done += 1
+                    if done * self.segment_size < len(payload):
+                        remaining.append((stream, memoryview(payload)[done * self.segment_size:]))
+                if len(remaining) == 1 and remaining[0][0] == 0:
+                    return self.rdt_client_connect(early_data=remaining[0][1])
                 self.rdt_client_connect()
+                if self.state == self.STATE_ESTABLISHED:
+                    self.rdt_send_many(remaining)
+                return
+
+    # Segments of messages as (message index, stream, segment, final, length) in the order they go out - a
+    # segment of each stream's current message in turn
+    def interleave_segments(self, messages):
+        by_stream = {}
+        for index, (stream, payload) in enumerate(messages):
+            by_stream.setdefault(stream, []).append(index)
+        turns = deque(self.stream_segments(indexes, messages) for indexes in by_stream.values())
+        while turns:
+            segments = turns.popleft()
+            segment = next(segments, None)
+            if segment is not None:
+                yield segment
+                turns.append(segments)
+
+    # Segments of one stream's messages, one message after another
+    def stream_segments(self, indexes, messages):
+        for index in indexes:
+            stream, payload = messages[index]
+            count = -(-len(payload) // self.segment_size)
+            for number, segment in enumerate(self.split_payload(payload)):
+                yield index, stream, segment, number == count - 1, len(payload)
+
+    # Send a cumulative ACK for everything up to ack_num. A windowed receiver also lists the
+    # segments it is holding past a gap so the sender does not resend them.
+    # ACKs do not consume a sequence number. They carry the last one the peer has from us, which
+    # legacy peers expect our next DATA to follow.
+    def rdt_send_ack(self, selective=()):
+        with self.ack_lock:
+            payload = self.codec.pack_sack(selective)
+            seq_num = min(self.unacked_packets) - 1 if self.unacked_packets else self.seq_num
+            self.rdt_send_packet(self.PACKET_TYPE_ACK, payload, final=self.final, seq_num=seq_num, ack_num=self.ack_num)
+            self.ack_sent()
+
+    # Timer thread - the delayed ACK for the end of a message is due and nothing else carried it
+    def send_delayed_ack(self):
+        with self.ack_lock:
+            if self.segments_unacked and self.state == self.STATE_ESTABLISHED:
+                self.rdt_send_ack()
 
     # Lower level reliable send function
-    def rdt_send_packet(self, packet_type, payload, final=0, resend=False, seq_num=None, ack_num=None):
+    # length is the length of the whole message a DATA segment is part of
+    def rdt_send_packet(self, packet_type, payload, final=0, resend=False, seq_num=None, ack_num=None, stream=None, length=0):
         # The only time we override seq_num and ack_num are for a special case where we are just giving a blanket re-ack
-        # for a packet we already moved past
+        # for a packet we already moved past. Nobody keeps these.
         if seq_num is not None and ack_num is not None:
-             header = struct.pack(self.HEADER_FORMAT, packet_type, seq_num, ack_num, self.ENABLE_FLAG if final else self.DISABLE_FLAG, self.ENABLE_FLAG if resend else self.DISABLE_FLAG)
-             packet = header + payload
-             self.send_packet(packet, dropchance=packet_type in (self.PACKET_TYPE_DATA, self.PACKET_TYPE_ACK))
+             packet = self.codec.pack(packet_type, seq_num, ack_num, self.ENABLE_FLAG if final else self.DISABLE_FLAG,
+                                      self.ENABLE_FLAG if resend else self.DISABLE_FLAG, self.receive_window(), payload)
+             self.send_packet(packet)
              return
         if resend:
-            # Resend the cached packet
-            packet = self.cached_packet
-            header = packet[:self.HEADER_SIZE]
-            payload = packet[self.HEADER_SIZE:]
-            packet_type, seq_num, ack_num, final, resent = struct.unpack(self.HEADER_FORMAT, header)
-            # Rebuild packet with resent flag ON
-            resent = self.ENABLE_FLAG
-            header = struct.pack(self.HEADER_FORMAT, packet_type, seq_num, ack_num, final, resent)
-            packet = header + payload
-            print(
-                f"Resending packet type {packet_type} with sequence {self.seq_num}, ack {self.ack_num}, final {final}, payload '{payload.decode()}'")
+            # Resend a cached packet - a specific segment still in flight, or the most recent one.
+            # Its resent flag goes on (and its receive window is brought up to date), in place from the second time.
+            if seq_num is None:
+                packet = self.cached_packet = self.codec.mark_resent(self.cached_packet, self.receive_window())
+            else:
+                packet = self.unacked_packets[seq_num] = self.codec.mark_resent(self.unacked_packets[seq_num], self.receive_window())
+            self.counters.retransmits += 1
+            if logger.isEnabledFor(logging.DEBUG):
+                packet_type, seq_num, ack_num, final, resent, rwnd, stream, length, payload = self.codec.parse(packet)
+                logger.debug("Resending packet type %d with sequence %d, ack %d, final %d, %d byte payload",
+                             packet_type, seq_num, ack_num, final, len(payload))
         else:
+            # Only take the sequence number once the packet is built - if it cannot be, nothing is skipped
+            packet = self.codec.pack(packet_type, self.seq_num + 1, self.ack_num, self.ENABLE_FLAG if final else self.DISABLE_FLAG,
+                                     self.ENABLE_FLAG if resend else self.DISABLE_FLAG, self.receive_window(), payload, stream, length)
             self.seq_num += 1
-            print(
-                f"Sending packet type {packet_type} with sequence {self.seq_num}, ack {self.ack_num}, final {final}, payload '{payload.decode()}'")
-            header = struct.pack(self.HEADER_FORMAT, packet_type, self.seq_num, self.ack_num, self.ENABLE_FLAG if final else self.DISABLE_FLAG, self.ENABLE_FLAG if resend else self.DISABLE_FLAG)
-            packet = header + payload
+            logger.debug("Sending packet type %d with sequence %d, ack %d, final %d, %d byte payload",
+                         packet_type, self.seq_num, self.ack_num, final, len(payload))
             # Cache the packet
             self.cached_packet = packet
+            if packet_type == self.PACKET_TYPE_DATA:
+                self.counters.data_bytes_sent += len(payload)
+                with self.ack_lock:
+                    # DATA carries our ACK number, so any ACK we were holding back rides along with it
+                    self.ack_sent()
+                    self.unacked_packets[self.seq_num] = packet
 
-        self.send_packet(packet, dropchance=packet_type in (self.PACKET_TYPE_DATA, self.PACKET_TYPE_ACK))
-        #self.send_packet(packet, dropchance=(packet_type==self.PACKET_TYPE_DATA))
+        self.send_packet(packet)
 
     #########################################################
     ##### These are the underlying unreliable functions #####
     #########################################################
 
     # Receive packet, used by either server or client
+    # Datagrams that arrived together are read in one go and handed out one per call, so a busy
+    # connection only goes to the kernel once per batch. What we hand out is a view of a reused buffer.
     def wait_for_packet(self, timeout=None):
-        # Receive packet
-        try:
-            self.udp_socket.settimeout(timeout)
-            data, client_address = self.udp_socket.recvfrom(self.UDP_BUFFER)
-            self.udp_socket.settimeout(None)
+        # A listener's connection gets its datagrams from the listener, already sorted by peer
+        if self.inbox is not None:
+            try:
+                return self.inbox.get(timeout=timeout)
+            except queue.Empty:
+                return None
+        if not self.received:
+            # Wait for the socket to have something for us, then read everything that is there
+            readable, _, _ = select.select([self.udp_socket], [], [], timeout)
+            if not readable:
+                return None
+            self.receive_batch()
+        return self.received.popleft() if self.received else None
+
+    # Read every waiting datagram (up to RECV_BATCH) without blocking, each into its own buffer
+    def receive_batch(self):
+        if self.recv_buffers is None:
+            size = min(HeaderCodec.MAX_HEADER_SIZE + self.max_segment_size + self.RECV_SLACK, self.UDP_BUFFER)
+            self.recv_buffers = [memoryview(bytearray(size)) for _ in range(self.RECV_BATCH)]
+        while len(self.received) < self.RECV_BATCH:
+            buffer = self.recv_buffers[self.recv_next]
+            try:
+                nbytes, client_address = self.udp_socket.recvfrom_into(buffer)
+            except BlockingIOError:
+                break
+            self.recv_next = (self.recv_next + 1) % self.RECV_BATCH
             # Store client address
             self.client_address = client_address
-            return data
-        except socket.timeout:
-            return None
+            self.received.append(buffer[:nbytes])
 
-    # Send packet, used by either server or client
-    def send_packet(self, packet, dropchance = False):
-        # Add unreliability for testing :evil:
-        if dropchance and floor(random()*1000000)%10 < self.DROP_CHANCE*10:
-            print(f"(Dropped send)")
-            return
+    # Whether another packet is already here, so that reading it will not block
+    def packets_waiting(self):
+        return bool(self.stashed_packets or self.received or (self.inbox is not None and not self.inbox.empty()))
+
+    # Loss, delay and so on are up to the link layer - an emulated link may drop the packet
+    def send_packet(self, packet):
+        # A client only has the server's host until the first reply tells it the full address
+        if isinstance(self.client_address, tuple):
+            address = self.client_address
         else:
-            # Send the packet using the UDP socket
-            # The sendto function has different requirements depending on client/server and location in code
-            if self.state == self.STATE_INIT:
-                self.udp_socket.sendto(packet, (self.client_address, self.port))
-            else:
-                self.udp_socket.sendto(packet, self.client_address)
+            address = (self.client_address, self.port)
+        self.counters.packets_sent += 1
+        self.counters.bytes_sent += len(packet)
+        if packet[0] == self.PACKET_TYPE_RESET:
+            self.counters.resets_sent += 1
+        try:
+            sent = self.link.send(self.udp_socket.sendto, packet, address)
+        except (BlockingIOError, socket.timeout):
+            # Socket send buffer is full - the packet is lost, just as if the network had dropped it.
+            # A listener's shared socket has a timeout rather than being non-blocking, so it times out instead.
+            sent = False
+        if not sent:
+            logger.debug("(Dropped send)")
+        if self.trace is not None:
+            self.trace_packet(PacketTrace.SENT if sent else PacketTrace.DROPPED, packet)
 
     #############################
     ##### Utility functions #####
     #############################
 
     # Utility function to break a message into packets
+    # Hands out memoryview slices one at a time, so the payload is never copied up front
     def split_payload(self, payload):
-        packets = []
-        for i in range(0, len(payload), self.SEND_BYTE_SIZE):
-            packets.append(payload[i:i + self.SEND_BYTE_SIZE])
-        return packets
+        view = memoryview(payload)
+        for i in range(0, len(view), self.segment_size):
+            yield view[i:i + self.segment_size]
 
-    # Used to track FSM machine
-    def set_state(self, state):
-        self.state = state
-        print(f"Setting state to {state}")
+    # Close our socket - a listener's connection just leaves the listener's table instead
+    # A server on its own keeps listening for the next session
+    def close_socket(self):
+        with self.ack_lock:
+            self.ack_sent()
+        if self.listener is not None:
+            self.listener.remove(self)
+        elif not self.listening:
+            self.udp_socket.close()
+
+    # Server side - close the socket rdt_server_wait_connect kept open between sessions
+    def stop_listening(self):
+        if self.listening:
+            self.udp_socket.close()
+            self.udp_socket = None
+            self.listening = False
+
+    # Server side - hand over the segment that came in a resumed CONNECT, if rdt_receive has not had it yet.
+    # It is the first segment of stream 0.
+    def take_early_data(self, ready):
+        if self.early_data is None:
+            return
+        payload, final = self.early_data
+        self.early_data = None
+        self.deliver_segment(ready, payload, final, (0, 0) if self.stream_header else None)
+
+    # Receiving - segments for the caller are collected in the list ready
+    def hand_over(self, ready, stream, payload, final, length):
+        ready.append((stream, payload, final, length))
+        if final:
+            self.final = 1
+
+    # Everything received but not looked at yet - stashed, read off the socket, or queued by the listener
+    def queued(self):
+        received = len(self.stashed_packets) + len(self.received) + (self.inbox.qsize() if self.inbox is not None else 0)
+        return len(self.unacked_packets), received
+
+    # A listener's connection knows its peer's address, a client only the server's port
+    def peer_port(self):
+        return self.client_address[1] if isinstance(self.client_address, tuple) else self.port
 
     # This is not truly needed, but I opted to reset these header fields when a message is completed
     def do_reset(self):
         #self.seq_num = 0
         #self.ack_num = 1
-        self.final = 0
\ No newline at end of file
+        self.final = 0
+
+
+# Server side listener that lets many clients connect to one port at the same time.
+# A background thread reads every datagram from the shared socket and hands it to the
+# RDTOverUDP connection for that peer address, so each client gets its own sequence numbers,
+# cached packets, timers and FSM state. A slow or lossy client only ever blocks its own connection.
+class RDTListener:
+    # How often the background thread checks whether we have been closed
+    POLL_INTERVAL = 0.5
+    # A datagram passed on to our successor is the peer's IPv4 address and port, then the datagram itself
+    FORWARD_FORMAT = "!4sH"
+    FORWARD_SIZE = struct.calcsize(FORWARD_FORMAT)
+
+    # Any extra keyword options (window_size, segment_size...) are passed on to every connection.
+    # Every connection shares our ResumptionTokens, so a token from one is good for the next.
+    # A worker of a multi process server (see worker_pool.py) is handed its udp_socket already bound, and if it
+    # is taking over from an old worker, reads the datagrams that worker passes on from predecessor until it is gone.
+    def __init__(self, host, port, udp_socket=None, predecessor=None, **options):
+        self.host = host
+        self.port = port
+        self.options = options
+        self.options.setdefault("tokens", ResumptionTokens())
+        self.udp_socket = udp_socket if udp_socket is not None else self.bind_socket(host, port)
+        self.udp_socket.settimeout(self.POLL_INTERVAL)
+        self.predecessor = predecessor
+        if predecessor is not None:
+            predecessor.settimeout(self.POLL_INTERVAL)
+        self.successor = None
+        self.draining = False
+        self.drain_deadline = None
+        self.accepted = 0 # Connections started so far
+        self.finished = None # Merged stats() of every connection that has closed
+        self.connections = {} # Peer address -> RDTOverUDP
+        self.lock = threading.Lock()
+        self.new_connections = queue.Queue()
+        self.running = True
+        self.thread = threading.Thread(target=self.demultiplex, daemon=True)
+        self.thread.start()
+
+    # A UDP socket bound to our port. With reuse_port several sockets (in different processes) can be bound to
+    # the same port, and the kernel spreads clients over them by hashing each client's address and port.
+    @staticmethod
+    def bind_socket(host, port, reuse_port=False):
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        udp_socket.bind((host, port))
+        return udp_socket
+
+    # Hand out the next new connection, or None if nobody connects before the timeout.
+    # The connection has its CONNECT waiting - run rdt_server_wait_connect() on it to finish the handshake.
+    def accept(self, timeout=None):
+        try:
+            return self.new_connections.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    # Background loop sorting datagrams by peer address
+    def demultiplex(self):
+        while self.running:
+            if self.drain_deadline is not None and time.monotonic() > self.drain_deadline:
+                logger.debug("Drain timed out with %d connections open", len(self.connections))
+                self.close()
+                break
+            try:
+                if self.predecessor is not None:
+                    data, address = self.receive_forwarded()
+                else:
+                    data, address = self.udp_socket.recvfrom(RDTOverUDP.UDP_BUFFER)
+            except socket.timeout:
+                continue
+            except OSError:
+                # Socket was closed
+                break
+            if data:
+                self.dispatch(data, address)
+
+    # Next datagram our predecessor passed on. An empty one means it is gone and its socket is all ours.
+    def receive_forwarded(self):
+        forwarded = self.predecessor.recv(RDTOverUDP.UDP_BUFFER + self.FORWARD_SIZE)
+        if not forwarded:
+            logger.debug("Predecessor is done, reading our socket")
+            self.predecessor.close()
+            self.predecessor = None
+            return b"", None
+        host, port = struct.unpack_from(self.FORWARD_FORMAT, forwarded)
+        return forwarded[self.FORWARD_SIZE:], (socket.inet_ntoa(host), port)
+
+    # Hand one datagram to the connection for its peer
+    def dispatch(self, data, address):
+        with self.lock:
+            connection = self.connections.get(address)
+            if connection is None:
+                # While draining, anyone new is our successor's (or nobody's, if we are shutting down)
+                if self.draining:
+                    if self.successor is not None:
+                        try:
+                            self.successor.send(struct.pack(self.FORWARD_FORMAT, socket.inet_aton(address[0]), address[1]) + data)
+                        except OSError:
+                            # Successor is behind or gone - the peer resends it
+                            pass
+                        return
+                    if data[0] == RDTOverUDP.PACKET_TYPE_CONNECT:
+                        return
+                # Only a CONNECT starts a new connection
+                if data[0] == RDTOverUDP.PACKET_TYPE_CONNECT:
+                    connection = RDTOverUDP(self.host, self.port, listener=self, peer=address, **self.options)
+                    self.connections[address] = connection
+                    self.accepted += 1
+                    self.new_connections.put(connection)
+                # The peer of a connection we already closed missed our DISCONNECT_ACK - send it another
+                elif data[0] == RDTOverUDP.PACKET_TYPE_DISCONNECT:
+                    try:
+                        self.udp_socket.sendto(struct.pack(RDTOverUDP.HEADER_FORMAT, RDTOverUDP.PACKET_TYPE_DISCONNECT_ACK, 0, 0, 0, 0), address)
+                    except (BlockingIOError, socket.timeout):
+                        # Send buffer is full - the peer asks again
+                        pass
+                    return
+                # Anything else is left over from an old connection
+                else:
+                    return
+        connection.inbox.put(data)
+
+    # Stop taking new clients, and close once every connection we have is done or after timeout seconds.
+    # With a successor (a socket from socket.socketpair(AF_UNIX, SOCK_DGRAM)), datagrams from anyone we don't
+    # already know are passed on to it instead of dropped, so a new worker can take over our socket without
+    # losing a client - it gets its share from us until we close, and then reads the socket itself.
+    def drain(self, successor=None, timeout=None):
+        with self.lock:
+            # Draining again (to shut down, say) keeps passing things on to a successor we already have
+            if successor is not None:
+                # Never block our whole socket on a slow successor
+                successor.setblocking(False)
+                self.successor = successor
+            self.draining = True
+            if timeout is not None:
+                self.drain_deadline = time.monotonic() + timeout
+            done = not self.connections
+        if done:
+            self.close()
+
+    # Forget a connection once it is closed - its stats go into our running total
+    def remove(self, connection):
+        snapshot = connection.stats()
+        with self.lock:
+            if self.connections.get(connection.client_address) is connection:
+                del self.connections[connection.client_address]
+                self.finished = ConnectionStats.merge([self.finished, snapshot])
+            done = self.draining and not self.connections
+        if done:
+            self.close()
+
+    # Stats of every connection we have had, open or closed, added up (see ConnectionStats.merge), plus
+    # how many we have accepted and how many are open right now
+    def stats(self):
+        with self.lock:
+            connections = list(self.connections.values())
+            finished = self.finished
+        snapshot = ConnectionStats.merge([finished] + [connection.stats() for connection in connections])
+        snapshot.update(accepted=self.accepted, open=len(connections), draining=self.draining)
+        return snapshot
+
+    # Stop listening - this drops every connection still open
+    def close(self):
+        self.running = False
+        self.udp_socket.close()
+        # Let our successor know the socket is its own now - nothing else gets passed on after this
+        with self.lock:
+            successor, self.successor = self.successor, None
+        if successor is not None:
+            try:
+                successor.send(b"")
+            except OSError:
+                pass
+            successor.close()
@@ -0,0 +1,140 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from random import Random
+
+# Link layers sit between a transport and its socket. RDTOverUDP and AsyncRDTConnection hand every
+# datagram to link.send(sendto, packet, address) - the default DirectLink just calls sendto, and the
+# NetworkEmulator below makes a loopback link behave like a bad network.
+
+
+# Emulated network path for testing and benchmarking on one machine.
+# Every random choice comes from one seeded RNG, so a run with the same seed and the same traffic makes
+# the same decisions. Share one emulator between both ends for a half-duplex link, or give each end
+# its own for independent directions.
+#     link = NetworkEmulator(loss=0.1, latency=0.02, jitter=0.005, seed=1)
+#     connection = RDTOverUDP(host, port, window_size=16, link=link)
+class NetworkEmulator:
+    # loss, reorder and duplicate are probabilities per packet.
+    # latency and jitter are in seconds - each packet is delayed by latency plus up to +/- jitter.
+    # Reordered packets are held back an extra reorder_delay seconds so later packets overtake them.
+    # bandwidth caps the link in bytes per second, and queue_bytes is how much can wait behind the
+    # cap before packets are dropped off the tail (None means no limit).
+    def __init__(self, loss=0.0, latency=0.0, jitter=0.0, reorder=0.0, reorder_delay=0.01, duplicate=0.0,
+                 bandwidth=None, queue_bytes=None, seed=None):
+        self.loss = loss
+        self.latency = latency
+        self.jitter = jitter
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.duplicate = duplicate
+        self.bandwidth = bandwidth
+        self.queue_bytes = queue_bytes
+        self.random = Random(seed)
+        self.lock = threading.Lock()
+        self.link_free_at = 0.0 # When the bandwidth cap lets the next packet start
+        self.stats = {"sent": 0, "dropped": 0, "duplicated": 0, "reordered": 0}
+        # Delayed packets for blocking transports - sent by a background thread
+        self.pending = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition(self.lock)
+        self.thread = None
+        self.running = True
+
+    # Pass one packet over the emulated link - gives False if it was dropped
+    def send(self, sendto, packet, address):
+        with self.lock:
+            if self.random.random() < self.loss:
+                self.stats["dropped"] += 1
+                return False
+            copies = 1
+            if self.random.random() < self.duplicate:
+                self.stats["duplicated"] += 1
+                copies = 2
+            delays = []
+            for _ in range(copies):
+                delay = self.link_delay(len(packet))
+                if delay is None:
+                    self.stats["dropped"] += 1
+                    return False
+                delays.append(delay)
+            self.stats["sent"] += 1
+        for delay in delays:
+            self.deliver(sendto, packet, address, delay)
+        return True
+
+    # How long this packet takes to get out, or None if the queue behind the bandwidth cap is full.
+    # Called with the lock held.
+    def link_delay(self, size):
+        now = time.monotonic()
+        delay = 0.0
+        if self.bandwidth:
+            start = max(now, self.link_free_at)
+            if self.queue_bytes is not None and (start - now) * self.bandwidth > self.queue_bytes:
+                return None
+            self.link_free_at = start + size / self.bandwidth
+            delay = self.link_free_at - now
+        delay += self.latency
+        if self.jitter:
+            delay += self.random.uniform(-self.jitter, self.jitter)
+        if self.reorder and self.random.random() < self.reorder:
+            self.stats["reordered"] += 1
+            delay += self.reorder_delay
+        return max(delay, 0.0)
+
+    # Send now, or later from the event loop or our own thread
+    def deliver(self, sendto, packet, address, delay):
+        if delay <= 0:
+            self.sendto(sendto, packet, address)
+            return
+        # Senders patch the packets they resend in place, so whatever we hold on to has to be our own copy
+        packet = bytes(packet)
+        # asyncio transports are not thread safe, so their packets wait on their own event loop
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is not None:
+            loop.call_later(delay, self.sendto, sendto, packet, address)
+            return
+        with self.condition:
+            heapq.heappush(self.pending, (time.monotonic() + delay, next(self.counter), sendto, packet, address))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    # Background thread sending delayed packets when they are due
+    def run(self):
+        with self.condition:
+            while self.running:
+                if not self.pending:
+                    self.condition.wait()
+                    continue
+                due = self.pending[0][0] - time.monotonic()
+                if due > 0:
+                    self.condition.wait(due)
+                    continue
+                _, _, sendto, packet, address = heapq.heappop(self.pending)
+                self.condition.release()
+                try:
+                    self.sendto(sendto, packet, address)
+                finally:
+                    self.condition.acquire()
+
+    # The socket may have been closed while the packet was on its way - it is lost, like on a real network
+    @staticmethod
+    def sendto(sendto, packet, address):
+        try:
+            sendto(packet, address)
+        except OSError:
+            pass
+
+    # Stop the background thread - packets still waiting are dropped
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.pending.clear()
+            self.condition.notify()
@@ -0,0 +1,92 @@
+import struct
+import sys
+import threading
+import time
+from collections import namedtuple
+
+# Compact binary trace of every packet a connection sends, receives or drops.
+# Each packet is one fixed size record of raw header fields - no text formatting on the
+# hot path - so it is cheap enough to leave running while chasing a problem in the field.
+# Read a trace back with read_trace(), or dump it as text with:
+#     python3 packet_trace.py trace.bin
+
+# One record per packet
+TraceRecord = namedtuple("TraceRecord", "timestamp direction packet_type seq_num ack_num final resent rwnd length peer_port")
+
+
+class PacketTrace:
+    # Every trace file starts with this, so we know what we are reading
+    MAGIC = b"RDTTRACE\x01"
+    # timestamp, direction, packet type, seq, ack, final, resent, receive window, payload length, peer port
+    RECORD_FORMAT = "!dBBIIBBHIH"
+    RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+    # Directions
+    SENT = 0
+    RECEIVED = 1
+    DROPPED = 2
+    DIRECTION_NAMES = {SENT: "sent", RECEIVED: "received", DROPPED: "dropped"}
+
+    # Packets without a receive window in their header are recorded with this instead
+    NO_RWND = 0xFFFF
+
+    # A trace can be shared by every connection of a listener or server - records are
+    # written whole under a lock and the peer port tells the connections apart
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(self.MAGIC)
+        self.lock = threading.Lock()
+        self.record_struct = struct.Struct(self.RECORD_FORMAT)
+
+    # Records keep the low 32 bits of the sequence and ACK numbers - v2 headers carry 64
+    def record(self, direction, packet_type, seq_num, ack_num, final, resent, rwnd, length, peer_port=0):
+        record = self.record_struct.pack(time.time(), direction, packet_type, seq_num & 0xFFFFFFFF, ack_num & 0xFFFFFFFF, final, resent,
+                                         self.NO_RWND if rwnd is None else rwnd, length, peer_port)
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(record)
+
+    def flush(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+# Read every record back out of a trace file
+def read_trace(path):
+    record_struct = struct.Struct(PacketTrace.RECORD_FORMAT)
+    with open(path, "rb") as trace_file:
+        if trace_file.read(len(PacketTrace.MAGIC)) != PacketTrace.MAGIC:
+            raise ValueError(f"{path} is not a packet trace")
+        while True:
+            data = trace_file.read(record_struct.size)
+            if len(data) < record_struct.size:
+                break
+            record = TraceRecord(*record_struct.unpack(data))
+            if record.rwnd == PacketTrace.NO_RWND:
+                record = record._replace(rwnd=None)
+            yield record
+
+
+# Print a trace as text, one line per packet, with times relative to the first packet
+def dump_trace(path, out=sys.stdout):
+    start = None
+    for record in read_trace(path):
+        if start is None:
+            start = record.timestamp
+        rwnd = "-" if record.rwnd is None else record.rwnd
+        out.write(f"{record.timestamp - start:10.6f} {PacketTrace.DIRECTION_NAMES.get(record.direction, record.direction):8} "
+                  f"port {record.peer_port:5} type {record.packet_type} seq {record.seq_num} ack {record.ack_num} "
+                  f"final {record.final} resent {record.resent} rwnd {rwnd} length {record.length}\n")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print(f"Usage: python3 {sys.argv[0]} trace.bin")
+        sys.exit(1)
+    dump_trace(sys.argv[1])
@@ -0,0 +1,53 @@
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+
+# Tiny local HTTP endpoint for watching a server - any GET gives back stats() as JSON, e.g.
+#     curl http://127.0.0.1:8080/
+# stats is any function returning plain dicts and numbers, like RDTListener.stats or WorkerPool.stats,
+# and is called on the endpoint's own thread. Only listens on localhost - it is for a monitoring agent
+# on the same machine, not for the world.
+class StatusServer:
+    HOST = "127.0.0.1"
+
+    def __init__(self, port, stats):
+        self.stats = stats
+        handler = type("StatusHandler", (StatusHandler,), {"status": self})
+        self.server = ThreadingHTTPServer((self.HOST, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    # Stop serving and free the port
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # A forked child has our socket but not our thread - it just drops its copy
+    def close_socket(self):
+        self.server.socket.close()
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    status = None # The StatusServer we belong to
+
+    def do_GET(self):
+        try:
+            body = json.dumps(self.status.stats(), indent=2).encode()
+        except Exception:
+            logger.exception("Could not collect stats")
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Requests are logged at DEBUG level instead of printed
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
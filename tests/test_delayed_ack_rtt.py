@@ -0,0 +1,74 @@
+import asyncio
+import threading
+import time
+
+from async_reliable_UDP import open_connection, start_server
+from more_reliable_UDP import DirectLink, RDTOverUDP
+
+# The server's reply is resent this long after it was dropped - any RTT sample near it is wrong
+SERVER_RTO = 1.0
+
+
+# Drops the first DATA packet sent over it
+class DropFirstData(DirectLink):
+    def __init__(self):
+        self.dropped = False
+
+    def send(self, sendto, packet, address):
+        if packet[0] == RDTOverUDP.PACKET_TYPE_DATA and not self.dropped:
+            self.dropped = True
+            return False
+        return super().send(sendto, packet, address)
+
+
+# Slow down a timer, so the client is not first to resend
+def slow_rto(rtt, rto):
+    rtt.base_rto = rtt.rto = rto
+
+
+# With delayed ACKs the reply to a request is what acknowledges it. If the reply is dropped and
+# resent, its round trip includes the server's timeout, and must not be used as an RTT sample.
+def test_resent_reply_is_not_timed():
+    server = RDTOverUDP("127.0.0.1", 23495, delayed_ack=True, link=DropFirstData())
+
+    def serve():
+        server.rdt_server_wait_connect()
+        slow_rto(server.rtt, SERVER_RTO)
+        server.rdt_send(server.rdt_receive())
+        server.rdt_receive()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    while server.state != RDTOverUDP.STATE_LISTEN:
+        time.sleep(0.01)
+    client = RDTOverUDP("127.0.0.1", 23495, delayed_ack=True)
+    client.rdt_client_connect()
+    slow_rto(client.rtt, 3 * SERVER_RTO)
+    client.rdt_send(b"ping")
+    assert client.rdt_receive() == b"ping"
+    assert server.link.dropped
+    assert client.rtt.srtt < SERVER_RTO / 20
+    client.close()
+    thread.join(5)
+    server.stop_listening()
+
+
+def test_async_resent_reply_is_not_timed():
+    async def main():
+        async def handler(connection):
+            slow_rto(connection.rtt, SERVER_RTO)
+            await connection.send(await connection.receive())
+            await connection.receive()
+
+        link = DropFirstData()
+        server = await start_server(handler, "127.0.0.1", 23496, delayed_ack=True, link=link)
+        client = await open_connection("127.0.0.1", 23496, delayed_ack=True)
+        slow_rto(client.rtt, 3 * SERVER_RTO)
+        await client.send(b"ping")
+        assert await client.receive() == b"ping"
+        assert link.dropped
+        assert client.rtt.srtt < SERVER_RTO / 20
+        await client.close()
+        server.close()
+
+    asyncio.run(main())
@@ -0,0 +1,87 @@
+import threading
+import time
+
+from more_reliable_UDP import DirectLink, RDTListener, RDTOverUDP
+
+# How long the network holds on to the copy of the CONNECT
+DUPLICATE_DELAY = 0.05
+
+
+# Sends every CONNECT twice, the second copy a little later - as a network that duplicates packets may
+class DuplicateConnect(DirectLink):
+    def send(self, sendto, packet, address):
+        if packet[0] == RDTOverUDP.PACKET_TYPE_CONNECT:
+            threading.Timer(DUPLICATE_DELAY, sendto, (bytes(packet), address)).start()
+        return super().send(sendto, packet, address)
+
+
+def echo_client(port):
+    client = RDTOverUDP("127.0.0.1", port, window_size=4, link=DuplicateConnect())
+    client.rdt_client_connect()
+    # Long enough that the duplicate CONNECT gets to a server that is already ESTABLISHED
+    time.sleep(2 * DUPLICATE_DELAY)
+    for message in (b"first", b"second" * 500):
+        client.rdt_send(message)
+        assert client.state == RDTOverUDP.STATE_ESTABLISHED
+        assert client.rdt_receive() == message
+    client.close()
+
+
+# A late copy of the CONNECT is answered with the SYNACK again, not a RESET that kills the connection
+def test_duplicate_connect():
+    server = RDTOverUDP("127.0.0.1", 23500, window_size=4)
+
+    def serve():
+        server.rdt_server_wait_connect()
+        for _ in range(2):
+            server.rdt_send(server.rdt_receive())
+        server.rdt_receive()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    while server.state != RDTOverUDP.STATE_LISTEN:
+        time.sleep(0.01)
+    echo_client(23500)
+    thread.join(5)
+    assert server.counters.resets_sent == 0
+    server.stop_listening()
+
+
+def test_duplicate_connect_listener():
+    listener = RDTListener("127.0.0.1", 23501, window_size=4)
+
+    def serve():
+        connection = listener.accept()
+        connection.rdt_server_wait_connect()
+        for _ in range(2):
+            connection.rdt_send(connection.rdt_receive())
+        connection.rdt_receive()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    try:
+        echo_client(23501)
+        thread.join(5)
+        assert listener.stats()["resets_sent"] == 0
+    finally:
+        listener.close()
+
+
+# A peer that has thrown the connection away answers with a RESET - the send gives up instead of
+# resending forever
+def test_reset_ends_send():
+    server = RDTOverUDP("127.0.0.1", 23502)
+    thread = threading.Thread(target=server.rdt_server_wait_connect, daemon=True)
+    thread.start()
+    while server.state != RDTOverUDP.STATE_LISTEN:
+        time.sleep(0.01)
+    client = RDTOverUDP("127.0.0.1", 23502)
+    client.rdt_client_connect()
+    thread.join(5)
+    # The server never reads the DATA, it just resets
+    threading.Timer(0.1, server.rdt_send_packet, (RDTOverUDP.PACKET_TYPE_RESET, b"")).start()
+    started = time.monotonic()
+    client.rdt_send(b"nobody is listening")
+    assert client.state == RDTOverUDP.STATE_CLOSED
+    assert time.monotonic() - started < 2
+    server.stop_listening()
@@ -0,0 +1,45 @@
+import asyncio
+import threading
+import time
+
+from async_reliable_UDP import open_connection, start_server
+from more_reliable_UDP import RDTOverUDP
+
+
+# Over localhost the handshake should leave both ends with a real RTT, well under the initial RTO
+def test_handshake_samples_rtt():
+    server = RDTOverUDP("127.0.0.1", 23480)
+    thread = threading.Thread(target=server.rdt_server_wait_connect, daemon=True)
+    thread.start()
+    # A CONNECT sent before the server is listening would be resent, and not timed
+    while server.state != RDTOverUDP.STATE_LISTEN:
+        time.sleep(0.01)
+    client = RDTOverUDP("127.0.0.1", 23480)
+    client.rdt_client_connect()
+    thread.join(5)
+    assert client.state == server.state == RDTOverUDP.STATE_ESTABLISHED
+    for end in (client, server):
+        assert end.rtt.srtt is not None
+        assert end.rtt.rto < RDTOverUDP.TIMEOUT
+    client.close()
+    server.stop_listening()
+
+
+def test_async_handshake_samples_rtt():
+    async def main():
+        accepted = asyncio.get_running_loop().create_future()
+
+        async def handler(connection):
+            accepted.set_result(connection)
+            await connection.receive()
+
+        server = await start_server(handler, "127.0.0.1", 23481)
+        client = await open_connection("127.0.0.1", 23481)
+        connection = await asyncio.wait_for(accepted, 5)
+        for end in (client, connection):
+            assert end.rtt.srtt is not None
+            assert end.rtt.rto < RDTOverUDP.TIMEOUT
+        await client.close()
+        server.close()
+
+    asyncio.run(main())
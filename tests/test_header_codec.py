@@ -0,0 +1,37 @@
+import struct
+
+from more_reliable_UDP import HeaderCodec, RDTOverUDP
+
+
+def test_v2_checksums_control_packets():
+    codec = HeaderCodec(2, extended=True)
+    for packet_type in (RDTOverUDP.PACKET_TYPE_RESET, RDTOverUDP.PACKET_TYPE_DISCONNECT, RDTOverUDP.PACKET_TYPE_DISCONNECT_ACK):
+        packet = codec.pack(packet_type, 5, 7, RDTOverUDP.DISABLE_FLAG, RDTOverUDP.DISABLE_FLAG, 4)
+        assert len(packet) == HeaderCodec.V2.size
+        assert codec.parse(packet)[:3] == (packet_type, 5, 7)
+        # Resends are sealed again
+        assert codec.parse(codec.mark_resent(packet, 4))[4] == RDTOverUDP.ENABLE_FLAG
+
+
+# A DATA packet whose type byte turns into RESET on the way fails its checksum instead of closing us
+def test_v2_drops_corrupted_type():
+    codec = HeaderCodec(2, extended=True)
+    packet = bytearray(codec.pack(RDTOverUDP.PACKET_TYPE_DATA, 5, 7, RDTOverUDP.ENABLE_FLAG, RDTOverUDP.DISABLE_FLAG, 4, b"hello", length=5))
+    for packet_type in (RDTOverUDP.PACKET_TYPE_RESET, RDTOverUDP.PACKET_TYPE_DISCONNECT, RDTOverUDP.PACKET_TYPE_DISCONNECT_ACK):
+        packet[0] = packet_type
+        assert codec.parse(packet) is None
+
+
+# What a listener sends a peer it has already forgotten still gets through
+def test_v2_takes_original_header_control_packets():
+    codec = HeaderCodec(2, extended=True)
+    packet = struct.pack(RDTOverUDP.HEADER_FORMAT, RDTOverUDP.PACKET_TYPE_DISCONNECT_ACK, 0, 0, 0, 0)
+    assert codec.parse(packet)[0] == RDTOverUDP.PACKET_TYPE_DISCONNECT_ACK
+    # Too short for v2 DATA is still just broken
+    assert codec.parse(bytes([RDTOverUDP.PACKET_TYPE_DATA]) + bytes(HeaderCodec.V1.size - 1)) is None
+
+
+def test_v1_control_packets_keep_original_header():
+    codec = HeaderCodec(1, extended=True)
+    packet = codec.pack(RDTOverUDP.PACKET_TYPE_RESET, 5, 7, RDTOverUDP.DISABLE_FLAG, RDTOverUDP.DISABLE_FLAG, 4)
+    assert len(packet) == HeaderCodec.V1.size
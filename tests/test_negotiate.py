@@ -0,0 +1,34 @@
+import pytest
+
+from async_reliable_UDP import AsyncRDTConnection
+from more_reliable_UDP import RDTOverUDP
+
+
+def test_option_int_clamps():
+    options = {"segment_size": "0", "receive_window": "-4", "version": "99"}
+    assert RDTOverUDP.option_int(options, "segment_size", 8, 1, 1200) == 1
+    assert RDTOverUDP.option_int(options, "receive_window", 4, 1, 0xFFFF) == 1
+    assert RDTOverUDP.option_int(options, "version", 1, 1, 2) == 2
+    assert RDTOverUDP.option_int(options, "missing", 7, 1, 10) == 7
+
+
+def test_negotiate_rejects_garbage():
+    connection = RDTOverUDP("127.0.0.1", 0, segment_size=1200)
+    connection.negotiate({"segment_size": "500"})
+    with pytest.raises(ValueError):
+        connection.negotiate({"segment_size": "abc", "receive_window": "4"})
+    # Nothing was changed by the bad handshake
+    assert connection.segment_size == 500
+    assert not connection.extended_header
+
+
+# Both transports settle the handshake the same way, and start with nothing left over from before
+@pytest.mark.parametrize("transport", [RDTOverUDP, AsyncRDTConnection])
+def test_negotiate_starts_clean(transport):
+    connection = transport("127.0.0.1", 0, window_size=4, streams=True)
+    connection.out_of_order[3] = (b"x", 0, None, None)
+    connection.stream_seqs[1] = 5
+    connection.negotiate({"segment_size": "500", "receive_window": "2", "streams": "1", "version": "2"})
+    assert (connection.segment_size, connection.rwnd, connection.codec.version) == (500, 2, 2)
+    assert connection.stream_header
+    assert not connection.out_of_order and not connection.stream_seqs
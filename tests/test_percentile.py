@@ -0,0 +1,18 @@
+from benchmarks.common import percentile
+
+
+def test_nearest_rank():
+    values = list(range(1, 11))
+    assert percentile(values, 0) == 1
+    assert percentile(values, 10) == 1
+    assert percentile(values, 25) == 3
+    assert percentile(values, 50) == 5
+    assert percentile(values, 90) == 9
+    assert percentile(values, 95) == 10
+    assert percentile(values, 100) == 10
+
+
+def test_unsorted_and_single():
+    assert percentile([30, 10, 20, 40], 50) == 20
+    assert percentile([30, 10, 20, 40], 75) == 30
+    assert percentile([7], 99) == 7
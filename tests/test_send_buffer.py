@@ -0,0 +1,20 @@
+import socket
+
+from more_reliable_UDP import RDTOverUDP, RDTListener
+
+
+# Stands in for a socket whose send buffer is full - the way a listener's shared socket fails
+class FullLink:
+    def send(self, sendto, packet, address):
+        raise socket.timeout("timed out")
+
+
+# A full send buffer loses the packet, like the network would, rather than killing the sender
+def test_full_send_buffer_drops_packet():
+    listener = RDTListener("127.0.0.1", 23490)
+    try:
+        connection = RDTOverUDP("127.0.0.1", 23490, listener=listener, peer=("127.0.0.1", 23491), link=FullLink())
+        connection.rdt_send_packet(RDTOverUDP.PACKET_TYPE_DATA, b"lost")
+        assert connection.counters.packets_sent == 1
+    finally:
+        listener.close()
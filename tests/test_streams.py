@@ -0,0 +1,99 @@
+import asyncio
+import struct
+import threading
+import time
+
+import pytest
+
+from async_reliable_UDP import open_connection, start_server
+from more_reliable_UDP import RDTOverUDP
+
+
+def stream_connection():
+    connection = RDTOverUDP("127.0.0.1", 0, window_size=4, streams=True)
+    connection.negotiate({"segment_size": "100", "receive_window": "4", "streams": "1"})
+    assert connection.stream_header
+    return connection
+
+
+def test_stream_ids_run_out_cleanly():
+    connection = stream_connection()
+    connection.next_stream = RDTOverUDP.MAX_STREAM - 1
+    assert connection.open_stream() == RDTOverUDP.MAX_STREAM
+    with pytest.raises(ValueError):
+        connection.open_stream()
+    with pytest.raises(ValueError):
+        connection.rdt_send(b"x", stream=RDTOverUDP.MAX_STREAM + 1)
+
+
+# A packet that cannot be built must not use up a sequence number
+def test_failed_pack_keeps_sequence():
+    connection = stream_connection()
+    with pytest.raises(struct.error):
+        connection.rdt_send_packet(RDTOverUDP.PACKET_TYPE_DATA, b"x", stream=(RDTOverUDP.MAX_STREAM + 1, 0))
+    assert connection.seq_num == 0
+    assert not connection.unacked_packets
+
+
+# Both ends forget a stream once a message has gone each way on it
+def test_close_stream_after_echo():
+    server = RDTOverUDP("127.0.0.1", 23510, window_size=4, streams=True)
+
+    def serve():
+        server.rdt_server_wait_connect()
+        stream, message = server.rdt_receive_message()
+        server.rdt_send(message, stream=stream)
+        server.rdt_receive()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    while server.state != RDTOverUDP.STATE_LISTEN:
+        time.sleep(0.01)
+    client = RDTOverUDP("127.0.0.1", 23510, window_size=4, segment_size=100, streams=True)
+    client.rdt_client_connect()
+    stream = client.open_stream()
+    message = bytes(range(256)) * 4
+    client.rdt_send(message, stream=stream)
+    assert client.rdt_receive_message() == (stream, message)
+    client.close()
+    thread.join(5)
+    server.stop_listening()
+    for end in (client, server):
+        end.close_stream(stream)
+        for state in (end.stream_seqs, end.stream_next, end.stream_held, end.stream_buffers):
+            assert stream not in state
+
+
+def test_async_close_stream_after_echo():
+    async def main():
+        done = asyncio.get_running_loop().create_future()
+
+        async def handler(connection):
+            stream, message = await connection.receive_message()
+            await connection.send(message, stream=stream)
+            done.set_result(connection)
+            await connection.receive()
+
+        server = await start_server(handler, "127.0.0.1", 23511, window_size=4, streams=True)
+        client = await open_connection("127.0.0.1", 23511, window_size=4, segment_size=100, streams=True)
+        stream = client.open_stream()
+        message = bytes(range(256)) * 4
+        await client.send(message, stream=stream)
+        assert await client.receive_message() == (stream, message)
+        connection = await asyncio.wait_for(done, 5)
+        for end in (client, connection):
+            end.close_stream(stream)
+            for state in (end.stream_seqs, end.stream_next, end.stream_held, end.stream_buffers, end.send_locks):
+                assert stream not in state
+        await client.close()
+        server.close()
+
+    asyncio.run(main())
+
+
+# Part of a message still held back out of order
+def test_close_stream_refuses_partial_message():
+    connection = stream_connection()
+    connection.stream_held[4] = {6: 20}
+    with pytest.raises(ValueError):
+        connection.close_stream(4)
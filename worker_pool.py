@@ -0,0 +1,256 @@
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+from more_reliable_UDP import ConnectionStats, RDTListener, ResumptionTokens
+from packet_trace import PacketTrace
+from status_server import StatusServer
+
+logger = logging.getLogger(__name__)
+
+
+# Multi process server - a launcher that forks one worker process per slot, each running its own RDTListener
+# (and so its own connection state) on a SO_REUSEPORT socket of its own, all bound to the same port. The kernel
+# hashes each client's address and port to one of the sockets, so a client always lands on the same worker.
+# We hold on to every slot's socket ourselves, which keeps the set of sockets - and so that hash - the same
+# for as long as we run, even while workers come and go.
+#   SIGHUP restarts every worker gracefully - a new worker starts on each slot, and the old one finishes the
+#          clients it has while passing the datagrams of anyone new on to it, then leaves it the socket
+#   SIGINT/SIGTERM stops taking new clients, waits for every worker to finish its clients (or DRAIN_TIMEOUT)
+#          and prints how many clients each slot served
+#   a worker that dies on its own is started again on its slot
+# Every worker sends its listener's stats() back to us as it exits - and every STATS_INTERVAL while it
+# runs, if we have a status endpoint - and stats() adds them all up.
+# Linux only - it needs SO_REUSEPORT and os.fork.
+class WorkerPool:
+    # How long a worker that has been told to stop waits for its clients to finish
+    DRAIN_TIMEOUT = 30.0
+    # How often we check on the workers
+    POLL_INTERVAL = 0.2
+    # How often workers send us their stats while we have a status endpoint
+    STATS_INTERVAL = 1.0
+    # Biggest report we expect from a worker
+    REPORT_BUFFER = 65536
+
+    # serve(listener) runs in every worker and should take clients until listener.running goes False.
+    # Each worker records to its own trace file, trace_path.<pid>, and any extra keyword options go to every
+    # worker's RDTListener. All the workers share one ResumptionTokens, so a client that resumes from a
+    # different port - which can hash to a different worker - is still recognised.
+    # With status_port, we serve the added up stats of every worker on a local StatusServer.
+    def __init__(self, host, port, workers, serve, trace_path=None, status_port=None, **options):
+        self.host = host
+        self.port = port
+        self.serve = serve
+        self.trace_path = trace_path
+        self.status_port = status_port
+        self.status = None
+        self.options = options
+        self.options.setdefault("tokens", ResumptionTokens())
+        self.sockets = [RDTListener.bind_socket(host, port, reuse_port=True) for _ in range(workers)]
+        self.workers = {} # pid -> slot, for every worker still running
+        self.current = {} # slot -> pid of the worker taking that slot's new clients
+        self.handovers = {} # slot -> (receive end, send end) of the channel its current worker passes datagrams on
+        self.retiring = {} # pid -> its handover channel, for workers finishing up after a restart
+        self.markers = [] # Handover channels whose successor still needs telling the old worker is gone
+        # Workers report their stats as one JSON datagram each, so reports from different workers never mix
+        self.reports, self.report_writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.reports.setblocking(False)
+        self.stats_lock = threading.Lock() # The status endpoint reads what we have from its own thread
+        self.worker_stats = {} # pid -> (slot, its latest stats), for every worker still running
+        self.finished = None # Merged final stats of every worker that has exited
+        self.served = [0] * workers # Clients served by the workers that have exited, by slot
+        self.restart_requested = False
+        self.stop_requested = False
+        self.stopping = False
+
+    # Start a worker on a slot - if predecessor is given, it takes over from the worker that passes datagrams on it
+    def start_worker(self, slot, predecessor=None):
+        handover = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self.run_worker(slot, predecessor, handover[1])
+                code = 0
+            except BaseException:
+                logger.exception("Worker on slot %d failed", slot)
+            finally:
+                os._exit(code)
+        self.workers[pid] = slot
+        self.current[slot] = pid
+        self.handovers[slot] = handover
+        return pid
+
+    # The worker side - runs in the forked process until its listener closes
+    def run_worker(self, slot, predecessor, successor):
+        # Ctrl-C reaches the whole process group, but what happens next is the launcher's call
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.reports.close()
+        if self.status is not None:
+            self.status.close_socket()
+        for other, udp_socket in enumerate(self.sockets):
+            if other != slot:
+                udp_socket.close()
+        options = dict(self.options)
+        if self.trace_path is not None:
+            options["trace"] = PacketTrace(f"{self.trace_path}.{os.getpid()}")
+        listener = RDTListener(self.host, self.port, udp_socket=self.sockets[slot], predecessor=predecessor, **options)
+        signal.signal(signal.SIGHUP, lambda signum, frame: listener.drain(successor, self.DRAIN_TIMEOUT))
+        signal.signal(signal.SIGTERM, lambda signum, frame: listener.drain(timeout=self.DRAIN_TIMEOUT))
+        if self.status is not None:
+            threading.Thread(target=self.report_periodically, args=(slot, listener), daemon=True).start()
+        try:
+            self.serve(listener)
+        finally:
+            listener.close()
+            if "trace" in options:
+                options["trace"].close()
+            self.report(slot, listener, final=True)
+
+    # Worker side - send our listener's stats to the launcher. A regular report is skipped if the launcher is
+    # behind, but the final one waits for room.
+    def report(self, slot, listener, final=False):
+        report = json.dumps({"slot": slot, "pid": os.getpid(), "final": final, "stats": listener.stats()}).encode()
+        try:
+            self.report_writer.send(report, 0 if final else socket.MSG_DONTWAIT)
+        except OSError:
+            # Behind, or gone altogether
+            pass
+
+    # Worker side - keep the launcher's status endpoint up to date
+    def report_periodically(self, slot, listener):
+        while listener.running:
+            time.sleep(self.STATS_INTERVAL)
+            self.report(slot, listener)
+
+    # Take in every report the workers have sent us
+    def read_reports(self):
+        while True:
+            try:
+                report = json.loads(self.reports.recv(self.REPORT_BUFFER))
+            except BlockingIOError:
+                return
+            with self.stats_lock:
+                if report["final"]:
+                    self.worker_stats.pop(report["pid"], None)
+                    self.finish(report["slot"], report["stats"])
+                else:
+                    self.worker_stats[report["pid"]] = (report["slot"], report["stats"])
+
+    # Fold the last stats of a worker that is gone into our totals
+    def finish(self, slot, stats):
+        self.finished = ConnectionStats.merge([self.finished, stats])
+        self.served[slot] += stats["accepted"]
+
+    # Stats of every worker, running or not, added up (see ConnectionStats.merge) - for the status endpoint
+    def stats(self):
+        with self.stats_lock:
+            running = list(self.worker_stats.values())
+            snapshot = ConnectionStats.merge([self.finished] + [stats for slot, stats in running])
+            served = list(self.served)
+        for slot, stats in running:
+            served[slot] += stats["accepted"]
+        snapshot.update(workers=len(running), accepted=sum(served), served=served,
+                        open=sum(stats["open"] for slot, stats in running))
+        return snapshot
+
+    # Start a new worker on every slot, and have each old one hand over to it
+    def restart(self):
+        print(f"Restarting {len(self.current)} workers")
+        for slot, old in list(self.current.items()):
+            channel = self.handovers[slot]
+            self.start_worker(slot, predecessor=channel[0])
+            # The new worker has its own copy of the receive end now
+            channel[0].close()
+            self.retiring[old] = channel
+            os.kill(old, signal.SIGHUP)
+
+    # Tell every worker to finish up
+    def stop(self):
+        print(f"Stopping {len(self.workers)} workers")
+        self.stopping = True
+        self.deadline = time.monotonic() + self.DRAIN_TIMEOUT + 5.0
+        for pid in self.workers:
+            os.kill(pid, signal.SIGTERM)
+
+    # A worker has exited
+    def reap(self, pid, status):
+        slot = self.workers.pop(pid)
+        # Its final report is normally waiting for us - if it crashed, the last one it sent will have to do
+        self.read_reports()
+        with self.stats_lock:
+            last = self.worker_stats.pop(pid, None)
+            if last is not None:
+                self.finish(*last)
+        channel = self.retiring.pop(pid, None)
+        if channel is not None:
+            # It normally tells its successor itself, but not if it crashed
+            self.markers.append(channel)
+            return
+        if self.current.get(slot) != pid or self.stopping:
+            return
+        print(f"Worker {pid} on slot {slot} exited with status {os.waitstatus_to_exitcode(status)}, restarting it")
+        for end in self.handovers.pop(slot):
+            end.close()
+        self.start_worker(slot)
+
+    # Tell successors whose old worker is gone that the socket is theirs - the channel is non-blocking
+    # once the old worker has started passing datagrams on, so a full one is tried again next time round
+    def send_markers(self):
+        waiting = []
+        for channel in self.markers:
+            try:
+                channel[1].send(b"")
+            except BlockingIOError:
+                waiting.append(channel)
+                continue
+            except OSError:
+                pass
+            channel[1].close()
+        self.markers = waiting
+
+    # Run the workers until we are stopped, then print what they served
+    def run(self):
+        signal.signal(signal.SIGHUP, lambda signum, frame: setattr(self, "restart_requested", True))
+        signal.signal(signal.SIGINT, lambda signum, frame: setattr(self, "stop_requested", True))
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, "stop_requested", True))
+        if self.status_port is not None:
+            self.status = StatusServer(self.status_port, self.stats)
+        for slot in range(len(self.sockets)):
+            self.start_worker(slot)
+        print(f"Started {len(self.sockets)} workers on {self.host}:{self.port}")
+
+        while self.workers:
+            if self.stop_requested and not self.stopping:
+                self.stop()
+            if self.restart_requested and not self.stopping:
+                self.restart_requested = False
+                self.restart()
+            if self.stopping and time.monotonic() > self.deadline:
+                for pid in self.workers:
+                    logger.debug("Worker %d did not stop in time, killing it", pid)
+                    os.kill(pid, signal.SIGKILL)
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid:
+                self.reap(pid, status)
+            else:
+                self.read_reports()
+                self.send_markers()
+                time.sleep(self.POLL_INTERVAL)
+
+        self.print_summary()
+
+    # Add up the reports every worker sent as it exited
+    def print_summary(self):
+        if self.status is not None:
+            self.status.close()
+        self.read_reports()
+        self.reports.close()
+        self.report_writer.close()
+        for udp_socket in self.sockets:
+            udp_socket.close()
+        per_slot = ", ".join(f"slot {slot}: {count}" for slot, count in enumerate(self.served))
+        print(f"All workers stopped - {sum(self.served)} clients served ({per_slot})")